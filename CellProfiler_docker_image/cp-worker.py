@@ -1,26 +1,63 @@
 from __future__ import print_function
-import boto3
+import bisect
+import csv
 import glob
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import os
 import re
+import shutil
 import subprocess, shlex
 import sys
+import threading
 import time
 import logging
 import watchtower
 import string
-from boto3.dynamodb.conditions import Key, Attr
-from collections import Counter
+from boto3.dynamodb.types import TypeSerializer
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from s3transfer.manager import TransferManager
+from s3transfer.utils import ChunksizeAdjuster
+from collections import Counter, OrderedDict
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
+import aws_clients
 import s3worker
 from JobQueue import JobQueue
 
+# how long a prefetched message is kept invisible while the current task runs,
+# it is extended again before it runs out
+PREFETCH_HOLD_SECONDS = 300
+
+# images are downloaded to this name first and renamed when complete
+PARTIAL_SUFFIX = '.partial'
+
+# the full CellProfiler output of a task, saved in the task output dir
+CP_LOG_FILE_NAME = 'cellprofiler.log'
+# put on the line queue once CellProfiler closed its output
+END_OF_OUTPUT = None
+
+# the image number columns written by ExportToSpreadsheet: ImageNumber in the image and
+# object tables, the two image numbers of a pair of objects in the relationships table
+IMAGE_NUMBER_COLUMN = 'ImageNumber'
+RELATIONSHIP_IMAGE_NUMBER_COLUMNS = ('First Image Number', 'Second Image Number')
+# the experiment table of ExportToSpreadsheet, one per run and without image numbers
+EXPERIMENT_FILE_SUFFIX = 'Experiment.csv'
+
+# the container level worker: reads the configuration, holds what the task slots share
+# (AWS clients, the image bucket mount and the log handler) and runs the slots.
+# every slot runs one CellProfiler process at a time, see TaskSlot
 class CpWorker():
     def __init__(self):
-        self.app_config = {}
-        self.app_config
         self.app_config = {}
         self.app_config['S3FS_CREDENTIAL_FILE'] = os.environ['S3FS_CREDENTIAL_FILE']
         self.app_config['IMAGE_DATA_BUCKET_DIR'] = os.environ['IMAGE_DATA_BUCKET_DIR']
@@ -28,11 +65,55 @@ class CpWorker():
         self.app_config['TASK_OUTPUT_DIR'] = os.environ['TASK_OUTPUT_DIR']
 
         self.app_config['task_queue_url'] = os.environ['TASK_QUEUE_URL']
+        # number of CellProfiler processes run at once, 0 to use one per core,
+        # as long as the memory of the container allows SLOT_MEMORY_MB per process
+        self.app_config['NUM_SLOTS'] = int(os.environ.get('NUM_SLOTS', '0'))
+        self.app_config['SLOT_MEMORY_MB'] = int(os.environ.get('SLOT_MEMORY_MB', '4096'))
+        # receive and stage the next task while CellProfiler is running
+        self.app_config['PREFETCH_NEXT_TASK'] = os.environ.get('PREFETCH_NEXT_TASK', 'false').lower() == 'true'
+        # run up to this many tasks of the same run and pipeline in one CellProfiler process,
+        # 1 to run every task on its own
+        self.app_config['TASK_BATCH_SIZE'] = int(os.environ.get('TASK_BATCH_SIZE', '1'))
+        # seconds between checks of the running tasks' messages, which are extended before they
+        # show up in the queue again. 0 to rely on the visibility timeout of the queue
+        self.app_config['VISIBILITY_HEARTBEAT_SECONDS'] = float(os.environ.get('VISIBILITY_HEARTBEAT_SECONDS', '30'))
+        # idle polling: keep long polling for IDLE_RECENT_WORK_SECONDS after the last task,
+        # then wait between polls, starting at IDLE_BACKOFF_START_SECONDS and doubling up to
+        # IDLE_BACKOFF_MAX_SECONDS. Stop a slot after IDLE_SHUTDOWN_SECONDS without work, 0 to never stop,
+        # the worker stops with its last slot
+        self.app_config['IDLE_RECENT_WORK_SECONDS'] = float(os.environ.get('IDLE_RECENT_WORK_SECONDS', '600'))
+        self.app_config['IDLE_BACKOFF_START_SECONDS'] = float(os.environ.get('IDLE_BACKOFF_START_SECONDS', '5'))
+        self.app_config['IDLE_BACKOFF_MAX_SECONDS'] = float(os.environ.get('IDLE_BACKOFF_MAX_SECONDS', '300'))
+        self.app_config['IDLE_SHUTDOWN_SECONDS'] = float(os.environ.get('IDLE_SHUTDOWN_SECONDS', '0'))
         self.app_config['LOG_GROUP_NAME'] = os.environ['CLOUDWATCH_LOG_GROUP_NAME']
         self.app_config['LOG_STREAM_NAME'] = os.environ['CLOUDWATCH_LOG_STREAM_NAME']
+        # task metrics are sent to the log stream LOG_STREAM_NAME-metrics, under this namespace
+        self.app_config['METRICS_NAMESPACE'] = os.environ.get('METRICS_NAMESPACE', 'CellProfilerWorker')
+        # CellProfiler output is sent to Cloudwatch in batches of up to LOG_BATCH_BYTES,
+        # a batch is sent at the latest LOG_BATCH_SECONDS after its first line
+        self.app_config['LOG_BATCH_SECONDS'] = float(os.environ.get('LOG_BATCH_SECONDS', '10'))
+        self.app_config['LOG_BATCH_BYTES'] = int(os.environ.get('LOG_BATCH_BYTES', '32768'))
 
-        self.task_config = {}
-        self.task_config['file_to_ignore'] = 'Experiment.csv'
+        # how CellProfiler reads the images:
+        #   - mount: through the image bucket mounted with s3fs
+        #   - stage: from local copies, downloaded into IMAGE_CACHE_DIR before the task starts.
+        #            the cache is kept under IMAGE_CACHE_MAX_GB, least recently used images go first
+        self.app_config['IMAGE_INPUT_MODE'] = os.environ.get('IMAGE_INPUT_MODE', 'mount')
+        if self.app_config['IMAGE_INPUT_MODE'] not in ['mount', 'stage']:
+            raise ValueError("Unknown IMAGE_INPUT_MODE: " + self.app_config['IMAGE_INPUT_MODE'])
+        self.app_config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR', '/home/ubuntu/image_cache')
+        self.app_config['IMAGE_CACHE_MAX_GB'] = float(os.environ.get('IMAGE_CACHE_MAX_GB', '50'))
+        self.app_config['IMAGE_DOWNLOAD_WORKERS'] = int(os.environ.get('IMAGE_DOWNLOAD_WORKERS', '10'))
+
+        # result upload: files of UPLOAD_PART_MB and more are uploaded in parts of that size,
+        # up to UPLOAD_CONCURRENCY requests at once for all slots. Uploads are checked against the
+        # ETag S3 returns, set UPLOAD_VERIFY_ETAG to false for buckets encrypted with SSE-KMS,
+        # whose ETags are not MD5 sums, to only check the size
+        self.app_config['UPLOAD_PART_MB'] = int(os.environ.get('UPLOAD_PART_MB', '16'))
+        self.app_config['UPLOAD_CONCURRENCY'] = int(os.environ.get('UPLOAD_CONCURRENCY', '10'))
+        self.app_config['UPLOAD_VERIFY_ETAG'] = os.environ.get('UPLOAD_VERIFY_ETAG', 'true').lower() == 'true'
+
+        self.app_config['FILE_TO_IGNORE'] = 'Experiment.csv'
 
         self.task_status = {}
         self.task_status['SCHEDULED'] = 'Scheduled'
@@ -46,55 +127,964 @@ class CpWorker():
         self.run_status['FAILED'] = 'Failed'
 
         self.logger = self.get_logger()
+        self.metrics_logger = self.get_metrics_logger()
         self.task_queue = JobQueue(self.app_config['task_queue_url'])
+        # a received message gets this long before it shows up in the queue again
+        self.task_visibility_timeout = self.task_queue.getVisibilityTimeout()
+        if self.app_config['VISIBILITY_HEARTBEAT_SECONDS'] > 0:
+            self.task_queue.startHeartbeat(self.app_config['VISIBILITY_HEARTBEAT_SECONDS'])
+
+        # boto3 clients are thread safe and shared by the slots, see aws_clients
+        self.s3_client = aws_clients.get_client('s3')
+        part_size = self.app_config['UPLOAD_PART_MB'] * 1024 * 1024
+        self.transfer_config = TransferConfig(multipart_threshold=part_size,
+                                              multipart_chunksize=part_size,
+                                              max_concurrency=self.app_config['UPLOAD_CONCURRENCY'])
+        self.transfer_manager = TransferManager(self.s3_client, self.transfer_config)
+        self.queues = {}
+        self.queues_lock = threading.Lock()
+
+        self.image_mount = ImageMount(self.app_config['IMAGE_DATA_BUCKET_DIR'],
+                                      self.app_config['S3FS_CREDENTIAL_FILE'])
+        self.image_cache = None
+        if self.app_config['IMAGE_INPUT_MODE'] == 'stage':
+            self.image_cache = ImageCache(self.app_config['IMAGE_CACHE_DIR'],
+                                          int(self.app_config['IMAGE_CACHE_MAX_GB'] * 1024 ** 3),
+                                          self.s3_client, self.app_config['IMAGE_DOWNLOAD_WORKERS'])
+
+        self.slots = [TaskSlot(self, i) for i in range(self.count_slots())]
+
+    # start every slot and wait until all of them stop
+    def run(self):
+        self.logger.info("starting " + str(len(self.slots)) + " task slots")
+        threads = []
+        for slot in self.slots:
+            thread = threading.Thread(target=self.run_slot, args=(slot,),
+                                      name='slot_' + str(slot.slot_id))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # join with a timeout, so the main thread still gets signals
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        if self.task_queue.heartbeat is not None:
+            self.logger.info("visibility heartbeat counters: " + str(self.task_queue.heartbeat.metrics))
+        self.task_queue.stopHeartbeat()
+        self.transfer_manager.shutdown()
+        self.image_mount.unmount()
+        self.logger.info("all task slots stopped, image mount counters: " +
+                         str(self.image_mount.metrics))
+
+    # a failed slot stops, the other slots keep working
+    def run_slot(self, slot):
+        try:
+            slot.run()
+        except Exception:
+            slot.logger.exception("task slot stopped by an error")
+
+    # number of task slots: NUM_SLOTS if set, otherwise one per core (NUM_CORES if set),
+    # fewer if the memory of the container can not give SLOT_MEMORY_MB to each
+    def count_slots(self):
+        if self.app_config['NUM_SLOTS'] > 0:
+            return self.app_config['NUM_SLOTS']
+
+        num_slots = int(os.environ.get('NUM_CORES') or multiprocessing.cpu_count())
+        memory_mb = get_memory_limit_mb()
+        if memory_mb is not None:
+            num_slots = min(num_slots, memory_mb // self.app_config['SLOT_MEMORY_MB'])
+        return max(1, num_slots)
+
+    # JobQueue of a queue url, created once and shared by the slots
+    def get_queue(self, queue_url):
+        with self.queues_lock:
+            if queue_url not in self.queues:
+                self.queues[queue_url] = JobQueue(queue_url)
+            return self.queues[queue_url]
+
+    # prepare logger
+    # the handler is shared by the slots, each slot adds its task to the records, see TaskLogAdapter
+    def get_logger(self):
+        logging.basicConfig(level=logging.INFO)
+        logger = logging.getLogger(__name__)
+
+        watchtower_config = {
+            'log_group': self.app_config['LOG_GROUP_NAME'],
+            'stream_name': self.app_config['LOG_STREAM_NAME'],
+            'use_queues': True,
+            'create_log_group': False
+        }
+
+        watchtowerlogger = watchtower.CloudWatchLogHandler(**watchtower_config)
+        watchtowerlogger.addFilter(DefaultTaskContext())
+        watchtowerlogger.setFormatter(logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(task_context)s - %(message)s'))
+        logger.addHandler(watchtowerlogger)
+        return logger
+
+    # metric records go to their own log stream, without formatting,
+    # CloudWatch reads them in embedded metric format and turns them into metrics
+    def get_metrics_logger(self):
+        logger = logging.getLogger(__name__ + '.metrics')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+
+        watchtower_config = {
+            'log_group': self.app_config['LOG_GROUP_NAME'],
+            'stream_name': self.app_config['LOG_STREAM_NAME'] + '-metrics',
+            'use_queues': True,
+            'create_log_group': False
+        }
+
+        watchtowerlogger = watchtower.CloudWatchLogHandler(**watchtower_config)
+        watchtowerlogger.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(watchtowerlogger)
+        return logger
+
+
+# memory available to the container in MB: the cgroup limit if there is one,
+# otherwise the memory of the host. None if it can not be found
+def get_memory_limit_mb():
+    memory_mb = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    memory_mb = int(line.split()[1]) // 1024
+                    break
+    except IOError:
+        pass
+
+    # cgroup v2 and v1, without a limit they hold "max" or a huge number
+    for limit_file in ['/sys/fs/cgroup/memory.max',
+                       '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+        except IOError:
+            continue
+        if limit.isdigit():
+            limit_mb = int(limit) // (1024 * 1024)
+            if memory_mb is None or limit_mb < memory_mb:
+                memory_mb = limit_mb
+    return memory_mb
+
+
+# the image bucket mount, shared by the task slots
+# the mount is kept between tasks, so the s3fs caches survive: it is only remounted when a task
+# needs another bucket or the mount is found broken.
+# file lists point into IMAGE_DATA_BUCKET_DIR, so only one bucket can be mounted at a time,
+# a slot that needs another bucket waits until the slots using the mounted one are done with it
+class ImageMount():
+    def __init__(self, mount_dir, credential_file):
+        self.mount_dir = mount_dir
+        self.credential_file = credential_file
+        self.the_bucket = None
+        self.users = 0
+        self.condition = threading.Condition()
+        self.metrics = {'mounts': 0, 'reuses': 0, 'unhealthy': 0}
+
+    # make the_bucket available to a task, reusing the mount if it is already there
+    def acquire(self, the_bucket, logger):
+        with self.condition:
+            while True:
+                if self.the_bucket == the_bucket:
+                    if self.is_healthy():
+                        self.metrics['reuses'] += 1
+                        break
+                    if self.users == 0:
+                        self.metrics['unhealthy'] += 1
+                        logger.info("mount of " + the_bucket + " is broken, mounting again")
+                        self.mount(the_bucket, logger)
+                        break
+                elif self.users == 0:
+                    self.mount(the_bucket, logger)
+                    break
+                self.condition.wait()
+            self.users += 1
+            logger.info("image mount counters: " + str(self.metrics))
+
+    # a task is done with the mount, it stays mounted for the next task
+    def release(self):
+        with self.condition:
+            self.users -= 1
+            if self.users == 0:
+                self.condition.notify_all()
+
+    # mount image s3 bucket to IMAGE_DATA_BUCKET_DIR, after unmounting what is there
+    def mount(self, the_bucket, logger):
+        self.unmount()
+        mount_s3_bucket_command = ("s3fs " + the_bucket +
+                                " " + self.mount_dir +
+                                " -o passwd_file=" +
+                                self.credential_file)
+        os.system(mount_s3_bucket_command)
+        self.metrics['mounts'] += 1
+        if self.is_healthy():
+            self.the_bucket = the_bucket
+            logger.info("mount successfully")
+        else:
+            logger.info("mount failed")
+
+    def unmount(self):
+        if self.the_bucket is not None or os.path.ismount(self.mount_dir):
+            os.system("umount " + self.mount_dir)
+        self.the_bucket = None
+
+    # the mount point is mounted and answers.
+    # a crashed s3fs leaves a mount point that fails with "transport endpoint is not connected"
+    def is_healthy(self):
+        try:
+            os.stat(self.mount_dir)
+        except OSError:
+            return False
+        return os.path.ismount(self.mount_dir)
+
+
+# local copies of the images, shared by the slots and kept between tasks
+# the least recently used images are removed to stay under max_bytes,
+# images of tasks that are staged or running are pinned and never removed
+class ImageCache():
+    def __init__(self, cache_dir, max_bytes, s3_client, max_workers):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.s3_client = s3_client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        # local path: size, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.pins = Counter()
+        # local path: future of a download in progress
+        self.downloads = {}
+        self.metrics = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes_downloaded': 0}
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.load()
+
+    # pick up the images left in cache_dir by an earlier worker
+    def load(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith(PARTIAL_SUFFIX):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, path, stat.st_size))
+
+        for mtime, path, size in sorted(found):
+            self.entries[path] = size
+            self.total_bytes += size
+        with self.lock:
+            self.evict()
+
+    # download images into the cache, in parallel, and pin them until released
+    # args:
+    #   - the_bucket: the image data bucket
+    #   - the_keys: keys of the images
+    #   - returns: the local paths of the images, in the order of the_keys
+    def stage(self, the_bucket, the_keys):
+        paths = []
+        futures = []
+        with self.lock:
+            for the_key in the_keys:
+                path = os.path.join(self.cache_dir, the_bucket, the_key)
+                paths.append(path)
+                self.pins[path] += 1
+                if path in self.entries:
+                    # mark as recently used
+                    self.entries[path] = self.entries.pop(path)
+                    self.metrics['hits'] += 1
+                elif path in self.downloads:
+                    futures.append(self.downloads[path])
+                    self.metrics['hits'] += 1
+                else:
+                    self.metrics['misses'] += 1
+                    self.downloads[path] = self.executor.submit(self.download, the_bucket, the_key, path)
+                    futures.append(self.downloads[path])
+
+        try:
+            for future in futures:
+                future.result()
+        except Exception as e:
+            self.release(paths)
+            raise e
+        return paths
+
+    # the images are no longer used by a task
+    def release(self, paths):
+        with self.lock:
+            for path in paths:
+                self.pins[path] -= 1
+                if self.pins[path] <= 0:
+                    del self.pins[path]
+            self.evict()
+
+    def download(self, the_bucket, the_key, path):
+        partial_copy = path + PARTIAL_SUFFIX
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # created by another download
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+            response = self.s3_client.get_object(Bucket=the_bucket, Key=the_key)
+            with open(partial_copy, 'wb') as f:
+                shutil.copyfileobj(response['Body'], f)
+            os.rename(partial_copy, path)
+        except Exception as e:
+            with self.lock:
+                del self.downloads[path]
+            if os.path.exists(partial_copy):
+                os.remove(partial_copy)
+            e.args += (the_bucket, the_key)
+            raise e
+
+        size = os.path.getsize(path)
+        with self.lock:
+            del self.downloads[path]
+            self.entries[path] = size
+            self.total_bytes += size
+            self.metrics['bytes_downloaded'] += size
+            self.evict()
+
+    # remove least recently used images that are not pinned until the cache fits in max_bytes
+    # called with the lock held
+    def evict(self):
+        for path in list(self.entries.keys()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if path in self.pins:
+                continue
+            size = self.entries.pop(path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.total_bytes -= size
+            self.metrics['evictions'] += 1
+
+
+# the ETag S3 gives a file uploaded with transfer_config: the MD5 of the file, or for
+# multipart uploads the MD5 of the MD5s of the parts, followed by the number of parts
+def get_local_etag(local_copy, transfer_config):
+    size = os.path.getsize(local_copy)
+    with open(local_copy, 'rb') as f:
+        if size < transfer_config.multipart_threshold:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+            return '"' + md5.hexdigest() + '"'
+
+        # the part size is adjusted the same way by the transfer manager
+        part_size = ChunksizeAdjuster().adjust_chunksize(transfer_config.multipart_chunksize, size)
+        part_digests = [hashlib.md5(part).digest() for part in iter(lambda: f.read(part_size), b'')]
+    return ('"' + hashlib.md5(b''.join(part_digests)).hexdigest() +
+            '-' + str(len(part_digests)) + '"')
+
+
+# open a file for the csv module: in binary mode on python 2, on python 3 as text
+# without newline translation, as the csv module of each version expects
+# args:
+#   - mode: 'r' or 'w'
+def open_csv(path, mode):
+    if sys.version_info[0] < 3:
+        return open(path, mode + 'b')
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+# tasks can run in the same CellProfiler process if they are of the same run,
+# use the same pipeline and read images from the same bucket
+def can_batch(task_config, other_config):
+    keys = ['run_id', 'cp_pipeline_file_bucket', 'cp_pipeline_file_key', 'image_data_bucket']
+    return all(task_config[key] == other_config[key] for key in keys)
+
+
+# merge the image file lists of a batch into one data file for CellProfiler
+# the header is the union of the headers, cells missing from a list are left empty
+#   - returns: the number of image sets of every list, in order
+def merge_file_lists(file_lists, merged_file):
+    headers = []
+    for file_list in file_lists:
+        with open_csv(file_list, 'r') as f:
+            for title in next(csv.reader(f), []):
+                if title not in headers:
+                    headers.append(title)
+
+    image_set_counts = []
+    with open_csv(merged_file, 'w') as out:
+        writer = csv.writer(out)
+        writer.writerow(headers)
+        for file_list in file_lists:
+            count = 0
+            with open_csv(file_list, 'r') as f:
+                for row in csv.DictReader(f):
+                    writer.writerow([row.get(title) or '' for title in headers])
+                    count += 1
+            image_set_counts.append(count)
+    return image_set_counts
+
+
+# split the output of a batch run into a dir per task under output_dir,
+# keeping the relative paths of the files
+# csv files are split by image set, with the image numbers starting from 1 again for every
+# task, see split_csv_by_image. The experiment table is copied to every task, and every
+# other file, like the CellProfiler log, goes with the first task
+# args:
+#   - image_set_counts: the number of image sets of every task, in the order of the merged list
+#   - returns: the output dir of every task
+def split_batch_output(output_dir, image_set_counts):
+    relative_paths = []
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        for filename in filenames:
+            relative_paths.append(os.path.relpath(os.path.join(dirpath, filename), output_dir))
+
+    task_dirs = [os.path.join(output_dir, 'batch_task_' + str(i)) for i in range(len(image_set_counts))]
+    # the first image number of every task
+    first_images = [sum(image_set_counts[:i]) + 1 for i in range(len(image_set_counts))]
+    for relative_path in relative_paths:
+        source = os.path.join(output_dir, relative_path)
+        if relative_path.endswith(EXPERIMENT_FILE_SUFFIX):
+            for task_dir in task_dirs[1:]:
+                target = os.path.join(task_dir, relative_path)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.copy(source, target)
+        elif relative_path.endswith('.csv'):
+            split_csv_by_image(source, relative_path, task_dirs, first_images)
+            continue
+        target = os.path.join(task_dirs[0], relative_path)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        shutil.move(source, target)
+    return task_dirs
+
+
+# write the rows of a csv file to the task they belong to, by the image number of the
+# first image number column: ImageNumber, or First Image Number in the relationships table.
+# Every task gets the file, with the header only if it has no rows
+# a table without image numbers cannot be split, it raises a ValueError
+def split_csv_by_image(source, relative_path, task_dirs, first_images):
+    with open_csv(source, 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        image_columns = [i for i, title in enumerate(header)
+                         if title == IMAGE_NUMBER_COLUMN or title in RELATIONSHIP_IMAGE_NUMBER_COLUMNS]
+        if not image_columns:
+            raise ValueError("No image number column in " + relative_path + ", cannot split it by task")
+
+        outputs = []
+        try:
+            for task_dir in task_dirs:
+                target = os.path.join(task_dir, relative_path)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                outputs.append(open_csv(target, 'w'))
+            writers = [csv.writer(x) for x in outputs]
+            for writer in writers:
+                writer.writerow(header)
+
+            for row in reader:
+                task_index = bisect.bisect_right(first_images, int(row[image_columns[0]])) - 1
+                for i in image_columns:
+                    if row[i]:
+                        row[i] = str(int(row[i]) - first_images[task_index] + 1)
+                writers[task_index].writerow(row)
+        finally:
+            for output in outputs:
+                output.close()
+    os.remove(source)
+
+
+# a metric record in CloudWatch embedded metric format
+# args:
+#   - namespace: the CloudWatch namespace of the metrics
+#   - metrics: {name: (value, unit)}
+#   - properties: {name: value} kept with the record, not turned into metrics
+def build_metric_record(namespace, metrics, properties):
+    record = dict(properties)
+    for name, (value, unit) in metrics.items():
+        record[name] = value
+    record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': namespace,
+            'Dimensions': [[]],
+            'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+        }]
+    }
+    return record
+
+
+# put the lines of a stream on a queue, then END_OF_OUTPUT
+# lines are bytes, readline returns an empty string at the end of the stream
+def read_lines(stream, lines):
+    for line in iter(stream.readline, b''):
+        lines.put(line)
+    lines.put(END_OF_OUTPUT)
+
+
+# lines of output to be sent as one log event
+# the batch is due when it holds max_bytes, or max_seconds after its first line.
+# a run of the same line is kept once, followed by the number of repeats
+class LogBatch():
+    def __init__(self, max_bytes, max_seconds):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.lines = []
+        self.num_bytes = 0
+        self.started = None
+        self.last_line = None
+        self.repeats = 0
+
+    def add(self, line):
+        if not line:
+            return
+        if line == self.last_line:
+            self.repeats += 1
+            return
+        self.end_repeats()
+        self.lines.append(line)
+        self.num_bytes += len(line) + 1
+        self.last_line = line
+        if self.started is None:
+            self.started = time.time()
+
+    def end_repeats(self):
+        if self.repeats > 0:
+            self.lines.append("(last line repeated " + str(self.repeats) + " more times)")
+            self.repeats = 0
+
+    def is_empty(self):
+        return self.started is None
+
+    def is_due(self):
+        return (not self.is_empty() and
+                (self.num_bytes >= self.max_bytes or
+                 time.time() - self.started >= self.max_seconds))
+
+    # seconds until the batch is due, None while it is empty
+    def seconds_left(self):
+        if self.is_empty():
+            return None
+        return max(self.started + self.max_seconds - time.time(), 0)
+
+    # the text of the log event, the batch starts over empty
+    def flush(self):
+        self.end_repeats()
+        text = "\n".join(self.lines)
+        self.lines = []
+        self.num_bytes = 0
+        self.started = None
+        self.last_line = None
+        return text
+
+
+# records logged through a slot carry its current task in task_context
+class TaskLogAdapter(logging.LoggerAdapter):
+    def __init__(self, logger, slot):
+        logging.LoggerAdapter.__init__(self, logger, {})
+        self.slot = slot
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {'task_context': self.slot.log_context}
+        return msg, kwargs
+
+
+# records logged outside of the slots have no task_context
+class DefaultTaskContext(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, 'task_context'):
+            record.task_context = 'worker'
+        return True
+
+
+# a task slot: receives tasks and runs them one after another in its own
+# input and output dirs, under TASK_INPUT_DIR and TASK_OUTPUT_DIR
+class TaskSlot():
+    def __init__(self, worker, slot_id):
+        self.worker = worker
+        self.slot_id = slot_id
+
+        self.app_config = dict(worker.app_config)
+        slot_dir = 'slot_' + str(slot_id)
+        self.app_config['TASK_INPUT_DIR'] = os.path.join(worker.app_config['TASK_INPUT_DIR'], slot_dir)
+        self.app_config['TASK_OUTPUT_DIR'] = os.path.join(worker.app_config['TASK_OUTPUT_DIR'], slot_dir)
+        for task_dir in [self.app_config['TASK_INPUT_DIR'], self.app_config['TASK_OUTPUT_DIR']]:
+            if not os.path.isdir(task_dir):
+                os.makedirs(task_dir)
+
+        self.task_config = {}
+        self.task_config['file_to_ignore'] = self.app_config['FILE_TO_IGNORE']
+
+        self.task_status = worker.task_status
+        self.run_status = worker.run_status
+
+        self.log_context = slot_dir
+        self.logger = TaskLogAdapter(worker.logger, self)
+        self.task_queue = worker.task_queue
+        self.task_visibility_timeout = worker.task_visibility_timeout
+        self.s3_client = worker.s3_client
+        self.image_mount = worker.image_mount
+        self.image_cache = worker.image_cache
+        self.holds_mount = False
 
         self.task_counter = 0
 
+        # idle polling state and counters
+        self.start_time = time.time()
+        self.last_task_time = None
+        self.idle_since = None
+        self.idle_backoff = self.app_config['IDLE_BACKOFF_START_SECONDS']
+        self.metrics = {'idle_seconds': 0.0, 'time_to_first_task': None}
+
 
     #################################
     # RUN CELLPROFILER PROCESS
     #################################
     # main work loop
+    # the seconds spent in each phase of a task are recorded in task_config['timings']:
+    # queue_wait (since the run was submitted), download, mount, cellprofiler, upload, cleanup
+    # and status_update. They are saved on the task item and sent as a metric record
     # order of actions:
     # - get task message from the queue
     # - mount image data bucket
     # - download image flie list and pipeline file
     # - start the work and log outout
     # - upload output back to S3
-    # - unmount image data bucket and clean up files
+    # - release image data bucket mount, it stays mounted for the next task, and clean up files
     # - update task status in dynamoDB
     # - check if the whole run is done, if yes, run result consolidation
+    # with TASK_BATCH_SIZE > 1, the tasks waiting in the queue are run together, see run_batch
+    # an error stops the slot, the tasks it holds go back to the queue, see clean_up_tasks
 
     def run(self):
-        while True:
-            print("getting next task")
-            msg, handle = self.task_queue.readMessage()
-            if msg is None:
-                time.sleep(300)
-                continue
+        next_task = None
+        try:
+            while True:
+                # for test only
+                if self.task_counter >= 2:
+                    break
+
+                if next_task is None:
+                    print(self.log_context + ": getting next task")
+                    next_task = self.fetch_task(self.app_config['TASK_INPUT_DIR'])
+                    if next_task is None:
+                        if not self.wait_for_work():
+                            break
+                        continue
+
+                self.record_work_seen()
+                task = next_task
+                next_task = None
+
+                if self.app_config['TASK_BATCH_SIZE'] > 1:
+                    tasks, next_task = self.gather_batch(task)
+                    if len(tasks) > 1:
+                        self.task_counter += len(tasks)
+                        self.run_batch(tasks)
+                        continue
+
+                self.task_counter += 1
+                # stage the next task in the other input dir while CellProfiler runs
+                prefetcher = None
+                if self.app_config['PREFETCH_NEXT_TASK'] and next_task is None:
+                    prefetcher = TaskPrefetcher(self, self.prefetch_dir(task['input_dir']))
+                try:
+                    self.run_task(task, prefetcher)
+                finally:
+                    self.clean_up_tasks([task])
+                    # reset task-related config. To be sure does not affect previous run
+                    for key, value in self.task_config.iteritems():
+                        self.task_config[key] = ''
+                    if prefetcher is not None:
+                        next_task = prefetcher.claim()
+        finally:
+            # a task received but not started yet
+            if next_task is not None:
+                self.clean_up_tasks([next_task])
 
-            self.task_counter += 1
-            self.prepare_for_task(msg)
-            self.logger.info("current task_id: " + self.task_config['task_id'])
-            cp_run_command = self.build_cp_run_command()
-            self.logger.info('Start the analysis with command: ' + cp_run_command)
-            
-            subp = subprocess.Popen(shlex.split(cp_run_command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            self.monitorAndLog(subp, self.logger)
+    # run a task in its own CellProfiler process, upload the output, update its status and
+    # delete its message. The message is returned to the queue if CellProfiler or the upload failed
+    # args:
+    #   - task: the task, from fetch_task
+    #   - prefetcher: started once CellProfiler runs, None to not prefetch
+    def run_task(self, task, prefetcher):
+        phase_start = time.time()
+        self.start_task(task)
+        timings = self.task_config['timings']
+        timings['mount'] = time.time() - phase_start
+        self.logger.info("current task_id: " + self.task_config['task_id'])
+        cp_run_command = self.build_cp_run_command()
+        self.logger.info('Start the analysis with command: ' + cp_run_command)
 
+        phase_start = time.time()
+        subp = subprocess.Popen(shlex.split(cp_run_command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if prefetcher is not None:
+            prefetcher.start()
+
+        return_code = self.monitorAndLog(subp, self.logger)
+        timings['cellprofiler'] = time.time() - phase_start
+        self.measure_images()
+
+        try:
+            if return_code != 0:
+                # the partial output of a failed run is not uploaded
+                self.clear_output_dir()
+                raise RuntimeError("CellProfiler exited with code " + str(return_code))
             self.upload_result_and_clean_up()
-            self.update_task_status(self.task_status['FINISHED'])
+        except Exception:
+            # the message shows up in the queue again and the task is run again
+            self.logger.exception("the task failed, returning it to the queue")
+            self.task_queue.returnMessage(task['handle'])
+            task['settled'] = True
+            self.emit_task_metrics('returned')
+            return
+
+        # a task delivered twice is only counted once in the run
+        phase_start = time.time()
+        if self.mark_task_finished():
             self.update_run_status()
+        timings['status_update'] = time.time() - phase_start
+        self.task_queue.deleteMessage(task['handle'])
+        task['settled'] = True
+        self.emit_task_metrics('finished')
 
-            # reset task-related config. To be sure does not affect previous run
-            for key, value in self.task_config.iteritems():
-                self.task_config[key] = ''
+    # after a task or batch, also when it failed: the messages neither deleted nor returned
+    # go back to the queue, and the image mount and the staged images are released.
+    # Safe to call again for the same tasks
+    def clean_up_tasks(self, tasks):
+        self.release_mount()
+        for task in tasks:
+            if not task.get('settled'):
+                self.logger.info("returning unfinished task " + str(task['task_config'].get('task_id')) +
+                                 " to the queue")
+                try:
+                    self.task_queue.returnMessage(task['handle'])
+                except Exception:
+                    # it shows up in the queue again after its timeout
+                    self.logger.exception("returning the task failed")
+                task['settled'] = True
+            self.release_staged_images(task['task_config'])
 
-            self.task_queue.deleteMessage(handle)
+    def acquire_mount(self):
+        self.image_mount.acquire(self.task_config['image_data_bucket'], self.logger)
+        self.holds_mount = True
 
-            # for test only
-            if self.task_counter >= 2:
-                break
+    # the running task or batch is done with the image mount, it stays mounted for the next task
+    def release_mount(self):
+        if self.holds_mount:
+            self.holds_mount = False
+            self.image_mount.release()
+
+    # a task is done with its images in the image cache
+    def release_staged_images(self, task_config):
+        if task_config.get('staged_images'):
+            self.image_cache.release(task_config['staged_images'])
+            task_config['staged_images'] = []
+
+    # called after a poll came back empty, decides how long to wait before the next poll
+    # returns False when the slot has been idle long enough to stop
+    def wait_for_work(self):
+        now = time.time()
+        if self.idle_since is None:
+            self.idle_since = now
+
+        idle_shutdown = self.app_config['IDLE_SHUTDOWN_SECONDS']
+        if idle_shutdown > 0 and now - self.idle_since >= idle_shutdown:
+            self.metrics['idle_seconds'] += now - self.idle_since
+            self.logger.info("no task for " + str(int(now - self.idle_since)) +
+                             " seconds, shutting down. " + str(self.metrics))
+            return False
+
+        # work was seen recently, more is likely coming: poll again right away,
+        # the poll itself waits up to 20 seconds for a message
+        if (self.last_task_time is not None and
+                now - self.last_task_time < self.app_config['IDLE_RECENT_WORK_SECONDS']):
+            return True
+
+        time.sleep(self.idle_backoff)
+        self.idle_backoff = min(self.idle_backoff * 2, self.app_config['IDLE_BACKOFF_MAX_SECONDS'])
+        return True
+
+    # a task was received, reset the idle polling and update the counters
+    def record_work_seen(self):
+        now = time.time()
+        if self.metrics['time_to_first_task'] is None:
+            self.metrics['time_to_first_task'] = now - self.start_time
+        if self.idle_since is not None:
+            self.metrics['idle_seconds'] += now - self.idle_since
+            self.idle_since = None
+        self.last_task_time = now
+        self.idle_backoff = self.app_config['IDLE_BACKOFF_START_SECONDS']
+        self.logger.info("slot counters: " + str(self.metrics))
+
+    # receive a task message and stage its inputs
+    # args:
+    #   - input_dir: where to download the image file list and pipeline file
+    #   - wait_seconds: how long to wait for a message
+    #   - returns: a dict with the message, receipt handle, task config and input dir,
+    #     and when the message was received and shows up again. None if no message
+    #     the message is returned to the queue if staging failed
+    def fetch_task(self, input_dir, wait_seconds=20):
+        msg, handle = self.task_queue.readMessage(wait_seconds)
+        if msg is None:
+            return None
+        received_at = time.time()
+        task = {'message': msg, 'handle': handle, 'task_config': {}, 'input_dir': input_dir,
+                'received_at': received_at, 'visible_at': received_at + self.task_visibility_timeout}
+        # the heartbeat keeps the message invisible while it is staged and run, until it is deleted
+        self.task_queue.trackMessage(handle, received_at, task['visible_at'])
+
+        try:
+            task_config = self.build_task_config(msg)
+            task['task_config'] = task_config
+            # submit_date is when the run was submitted, in milliseconds
+            task_config['timings']['queue_wait'] = received_at - int(task_config['submit_date']) / 1000.0
+            self.stage_task_inputs(task_config, input_dir)
+            task_config['timings']['download'] = time.time() - received_at
+        except Exception:
+            self.task_queue.returnMessage(handle)
+            self.release_staged_images(task['task_config'])
+            raise
+        return task
+
+    # switch to a fetched task, its inputs are already staged
+    def start_task(self, task):
+        self.task_config = task['task_config']
+        self.set_log_context()
+        if self.image_cache is None:
+            self.acquire_mount()
+
+    # receive the tasks waiting in the queue that can run in one CellProfiler process with
+    # first_task: same run, pipeline and image bucket. Stops at TASK_BATCH_SIZE tasks,
+    # an empty queue or the first task that does not fit
+    #   - returns: the batch, and the task that did not fit or None
+    def gather_batch(self, first_task):
+        batch_size = self.app_config['TASK_BATCH_SIZE']
+        # every task of the batch has its own input dir, none is the one of first_task
+        batch_dirs = [os.path.join(self.app_config['TASK_INPUT_DIR'], 'batch_' + str(i))
+                      for i in range(batch_size)]
+        batch_dirs = [x for x in batch_dirs if x != first_task['input_dir']]
+
+        tasks = [first_task]
+        try:
+            while len(tasks) < batch_size:
+                input_dir = batch_dirs[len(tasks) - 1]
+                if os.path.isdir(input_dir):
+                    shutil.rmtree(input_dir)
+                task = self.fetch_task(input_dir, wait_seconds=0)
+                if task is None:
+                    break
+                if not can_batch(first_task['task_config'], task['task_config']):
+                    return tasks, task
+                tasks.append(task)
+        except Exception:
+            self.clean_up_tasks(tasks)
+            raise
+        return tasks, None
+
+    # run a batch of tasks in one CellProfiler process
+    # the image file lists are merged into one data file, the output is split back per task,
+    # then every task is uploaded to its own output prefix, counted and deleted from the queue
+    # on its own. Mount and CellProfiler time are shared evenly between the tasks.
+    # the tasks not done when an error stops the batch are returned to the queue
+    def run_batch(self, tasks):
+        try:
+            self.run_batch_tasks(tasks)
+        finally:
+            self.clean_up_tasks(tasks)
+            for task in tasks[1:]:
+                shutil.rmtree(task['input_dir'], ignore_errors=True)
+
+    # see run_batch
+    def run_batch_tasks(self, tasks):
+        phase_start = time.time()
+        task_ids = [task['task_config']['task_id'] for task in tasks]
+
+        self.task_config = dict(tasks[0]['task_config'])
+        # the staged images belong to the tasks
+        self.task_config['staged_images'] = []
+        self.task_config['task_id'] = task_ids[0] + ' and ' + str(len(tasks) - 1) + ' more'
+        self.task_config['image_list_local_copy'] = os.path.join(
+            self.app_config['TASK_INPUT_DIR'], 'batch_file_list.csv')
+        image_set_counts = merge_file_lists([task['task_config']['image_list_local_copy'] for task in tasks],
+                                            self.task_config['image_list_local_copy'])
+        self.set_log_context()
+        if self.image_cache is None:
+            self.acquire_mount()
+        mount_seconds = time.time() - phase_start
+        self.logger.info("current batch: " + str(task_ids) + ", image sets: " + str(image_set_counts))
+        cp_run_command = self.build_cp_run_command()
+        self.logger.info('Start the analysis with command: ' + cp_run_command)
+
+        phase_start = time.time()
+        subp = subprocess.Popen(shlex.split(cp_run_command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return_code = self.monitorAndLog(subp, self.logger)
+        cellprofiler_seconds = time.time() - phase_start
+
+        # without output, every task of the batch is returned to the queue by finish_batch_task
+        output_dir = self.app_config['TASK_OUTPUT_DIR']
+        try:
+            if return_code != 0:
+                raise RuntimeError("CellProfiler exited with code " + str(return_code))
+            task_dirs = split_batch_output(output_dir, image_set_counts)
+        except Exception:
+            self.logger.exception("the batch has no usable output, returning the tasks to the queue")
+            task_dirs = [None] * len(tasks)
+
+        try:
+            for task, task_dir in zip(tasks, task_dirs):
+                self.task_config = task['task_config']
+                self.set_log_context()
+                self.task_config['batch_size'] = len(tasks)
+                self.task_config['timings']['mount'] = mount_seconds / len(tasks)
+                self.task_config['timings']['cellprofiler'] = cellprofiler_seconds / len(tasks)
+                self.finish_batch_task(task, task_dir)
+        finally:
+            self.clear_output_dir()
+
+    # upload the output of a task of a batch, then update its status and delete its message
+    # the message is returned to the queue if the upload failed
+    def finish_batch_task(self, task, task_dir):
+        timings = self.task_config['timings']
+        self.measure_images()
+        phase_start = time.time()
+        try:
+            if task_dir is None:
+                raise RuntimeError("No output of task " + self.task_config['task_id'])
+            self.upload_results(task_dir, self.task_config['run_record_bucket'],
+                                self.task_config['task_output_prefix'])
+        except Exception:
+            timings['upload'] = time.time() - phase_start
+            self.logger.exception("uploading the result failed, returning the task to the queue")
+            self.task_queue.returnMessage(task['handle'])
+            task['settled'] = True
+            self.emit_task_metrics('returned')
+            return
+        timings['upload'] = time.time() - phase_start
+
+        phase_start = time.time()
+        if self.mark_task_finished():
+            self.update_run_status()
+        timings['status_update'] = time.time() - phase_start
+        self.task_queue.deleteMessage(task['handle'])
+        task['settled'] = True
+        self.emit_task_metrics('finished')
+
+    # prefetched tasks alternate between two dirs under TASK_INPUT_DIR,
+    # so the next task never overwrites the inputs of the running one
+    def prefetch_dir(self, current_input_dir):
+        prefetch_dirs = [os.path.join(self.app_config['TASK_INPUT_DIR'], 'prefetch_' + str(i))
+                         for i in range(2)]
+        if current_input_dir == prefetch_dirs[0]:
+            return prefetch_dirs[1]
+        return prefetch_dirs[0]
 
 
 # prepare for task per the message from sqs
@@ -102,111 +1092,257 @@ class CpWorker():
 #   - set up variables per task. other part of the code will use those variables
 #   - mount image s3 bucket to IMAGE_DATA_BUCKET_DIR
 #   - download image file list and pipeline file
+# the main loop does the same in two steps, fetch_task and start_task, so the next task
+# can be staged while the current one runs
 
     def prepare_for_task(self, message):
-        self.task_config['user_id'] = message['user_id']
-        self.task_config['submit_date'] = message['submit_date']
-        self.task_config['run_id'] = message['run_id']
-        self.task_config['task_id'] = message['task_id']
+        self.task_config = self.build_task_config(message)
+        self.set_log_context()
+        if self.image_cache is None:
+            self.acquire_mount()
+        self.stage_task_inputs(self.task_config, self.app_config['TASK_INPUT_DIR'])
 
-        self.task_config['result_consolidation_queue_url'] = message['result_consolidation_queue_url']
+    # set up variables per task from the message
+    def build_task_config(self, message):
+        task_config = {}
+        task_config['file_to_ignore'] = self.app_config['FILE_TO_IGNORE']
+        task_config['timings'] = {}
+        task_config['image_count'] = 0
+        task_config['image_bytes'] = 0
+        # number of tasks run in the same CellProfiler process
+        task_config['batch_size'] = 1
+        task_config['user_id'] = message['user_id']
+        task_config['submit_date'] = message['submit_date']
+        task_config['run_id'] = message['run_id']
+        task_config['task_id'] = message['task_id']
 
-        self.task_config['run_table'] = message['run_table']
-        self.task_config['task_table'] = message['task_table']
-        self.task_config['image_data_bucket'] = message["image_data"]["s3_bucket"]
-        self.task_config['image_data_prefix'] = message["image_data"]["prefix"]
+        task_config['result_consolidation_queue_url'] = message['result_consolidation_queue_url']
 
-        self.task_config['cp_pipeline_file_bucket'] = message['pipeline_file'][
+        task_config['run_table'] = message['run_table']
+        task_config['task_table'] = message['task_table']
+        task_config['image_data_bucket'] = message["image_data"]["s3_bucket"]
+        task_config['image_data_prefix'] = message["image_data"]["prefix"]
+
+        task_config['cp_pipeline_file_bucket'] = message['pipeline_file'][
             's3_bucket']
-        self.task_config['cp_pipeline_file_key'] = message['pipeline_file']['key']
+        task_config['cp_pipeline_file_key'] = message['pipeline_file']['key']
 
-        self.task_config['run_record_bucket'] = message["run_record_location"][
+        task_config['run_record_bucket'] = message["run_record_location"][
             "s3_bucket"]
-        self.task_config['sub_task_record_prefix'] = message['sub_task_record_prefix']
-        self.task_config['final_output_prefix'] = message['final_output_prefix']
-        self.task_config['image_list_file_key'] = message['file_list_key']
-        self.task_config['task_input_prefix'] = message['task_input_prefix']
-        self.task_config['task_output_prefix'] = message['task_output_prefix']
+        task_config['sub_task_record_prefix'] = message['sub_task_record_prefix']
+        task_config['final_output_prefix'] = message['final_output_prefix']
+        task_config['image_list_file_key'] = message['file_list_key']
+        task_config['task_input_prefix'] = message['task_input_prefix']
+        task_config['task_output_prefix'] = message['task_output_prefix']
+        return task_config
 
-        self.set_handler_formatter()
+    # download image file list and pipeline file of a task into input_dir
+    def stage_task_inputs(self, task_config, input_dir):
+        if not os.path.isdir(input_dir):
+            os.makedirs(input_dir)
 
-        mount_s3_bucket_command = ("s3fs " + self.task_config['image_data_bucket'] +
-                                " " + self.app_config['IMAGE_DATA_BUCKET_DIR'] +
-                                " -o passwd_file=" +
-                                self.app_config['S3FS_CREDENTIAL_FILE'])
-        os.system(mount_s3_bucket_command)
-        if len(os.listdir(self.app_config['IMAGE_DATA_BUCKET_DIR'])) == 0:
-            self.logger.info("mount failed")
-        else:
-            self.logger.info("mount successfully")
+        s3 = self.s3_client
+        print("downloading image list of task " + task_config['task_id'] + "...")
+        task_config['image_list_local_copy'] = s3worker.download_file(
+            s3, task_config['run_record_bucket'],
+            task_config['image_list_file_key'], input_dir)
 
-        s3 = boto3.client('s3')
-        self.logger.info("downloading image list...")
-        self.task_config['image_list_local_copy'] = s3worker.download_file(
-            s3, self.task_config['run_record_bucket'],
-            self.task_config['image_list_file_key'], self.app_config['TASK_INPUT_DIR'])
+        print("downloading pileline file of task " + task_config['task_id'] + "...")
+        task_config['pipeline_file_local_copy'] = s3worker.download_file(
+            s3, task_config['cp_pipeline_file_bucket'],
+            task_config['cp_pipeline_file_key'], input_dir)
 
-        self.logger.info("downloading pileline file...")
-        self.task_config['pipeline_file_local_copy'] = s3worker.download_file(
-            s3, self.task_config['cp_pipeline_file_bucket'],
-            self.task_config['cp_pipeline_file_key'], self.app_config['TASK_INPUT_DIR'])
+        if self.image_cache is not None:
+            self.stage_images(task_config, input_dir)
 
-    # prepare logger
-    # the formatter is not set yet, will set the formatter by task
-    def get_logger(self):
-        logging.basicConfig(level=logging.INFO)
-        logger = logging.getLogger(__name__)
+    # download the images of a task into the image cache
+    # and point the URL_ columns of its image file list at the local copies
+    def stage_images(self, task_config, input_dir):
+        mount_url = 'file:' + os.path.join(self.app_config['IMAGE_DATA_BUCKET_DIR'], '')
+        with open_csv(task_config['image_list_local_copy'], 'r') as f:
+            rows = list(csv.reader(f))
 
-        watchtower_config = {
-            'log_group': self.app_config['LOG_GROUP_NAME'],
-            'stream_name': self.app_config['LOG_STREAM_NAME'],
-            'use_queues': True,
-            'create_log_group': False
-        }
-
-        watchtowerlogger = watchtower.CloudWatchLogHandler(**watchtower_config)
-        logger.addHandler(watchtowerlogger)
-        return logger
-
-    # set log handler formatter by task
-    def set_handler_formatter(self):
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - ' + 
-            self.task_config['run_id'] + ' - ' + self.task_config['task_id'] + ' - %(message)s')
+        cells = []
+        if rows:
+            url_columns = [i for i, title in enumerate(rows[0]) if title.startswith('URL_')]
+            cells = [(row, i) for row in rows[1:] for i in url_columns
+                     if row[i].startswith(mount_url)]
 
-        self.logger.handlers[0].setFormatter(formatter)
+        print("staging " + str(len(cells)) + " images of task " + task_config['task_id'] + "...")
+        local_copies = self.image_cache.stage(task_config['image_data_bucket'],
+                                              [row[i][len(mount_url):] for row, i in cells])
+        task_config['staged_images'] = local_copies
+        for (row, i), local_copy in zip(cells, local_copies):
+            row[i] = 'file:' + local_copy
 
+        staged_list = os.path.join(input_dir, 'staged_' + os.path.basename(task_config['image_list_local_copy']))
+        with open_csv(staged_list, 'w') as f:
+            csv.writer(f).writerows(rows)
+        task_config['image_list_local_copy'] = staged_list
+        print("image cache counters: " + str(self.image_cache.metrics))
 
+    # log records of the slot carry its current task from now on
+    def set_log_context(self):
+        self.log_context = ('slot_' + str(self.slot_id) + ' - ' + self.task_config['run_id'] +
+                            ' - ' + self.task_config['task_id'])
 
     # monitor output from CP process and send to Cloudwatch
+    # the full output is saved to CP_LOG_FILE_NAME in the task output dir and uploaded with the
+    # results. Cloudwatch gets it in batches, see LogBatch
+    #   - returns: the exit code of CellProfiler
     def monitorAndLog(self, process, logger):
-        while True:
-            output = process.stdout.readline()
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                print(output.strip())
-                logger.info(output)
+        # lines are read in another thread, so a batch is sent on time while CellProfiler is quiet
+        lines = queue.Queue()
+        reader = threading.Thread(target=read_lines, args=(process.stdout, lines))
+        reader.daemon = True
+        reader.start()
+
+        batch = LogBatch(self.app_config['LOG_BATCH_BYTES'], self.app_config['LOG_BATCH_SECONDS'])
+        num_lines = 0
+        num_events = 0
+        log_file_path = os.path.join(self.app_config['TASK_OUTPUT_DIR'], CP_LOG_FILE_NAME)
+        with open(log_file_path, 'ab') as log_file:
+            while True:
+                try:
+                    output = lines.get(timeout=batch.seconds_left())
+                except queue.Empty:
+                    output = b''
+                if output is END_OF_OUTPUT:
+                    break
+                if output:
+                    log_file.write(output)
+                    num_lines += 1
+                    batch.add(output.decode('utf-8', 'replace').rstrip())
+                if batch.is_due():
+                    logger.info(batch.flush())
+                    num_events += 1
+
+        if not batch.is_empty():
+            logger.info(batch.flush())
+            num_events += 1
+
+        return_code = process.wait()
+        logger.info("CellProfiler exited with code " + str(return_code) + ", " + str(num_lines) +
+                    " lines of output sent in " + str(num_events) + " log events")
+        return return_code
 
     # post processing after CellProfiler finish the analysis
     # it does the things below:
-    #   - upload result to corresponding s3 bucket
-    #   - clean up temporary files on local disk
-    #   - unmount image s3 bucket from IMAGE_DATA_BUCKET_DIR
+    #   - upload result to corresponding s3 bucket, each file is deleted once its upload is confirmed
+    #   - clean up temporary files on local disk, what is left failed to upload
+    #   - release the image bucket mount, it stays mounted for the next task
+    # raises an error if any file failed to upload
     def upload_result_and_clean_up(self):
-        s3 = boto3.client('s3')
-
-        self.logger.info(os.listdir(self.app_config['TASK_OUTPUT_DIR']))
-        upload_result_command = ("aws s3 mv " + self.app_config['TASK_OUTPUT_DIR'] +
-                                " \"s3://" + self.task_config['run_record_bucket'] +
-                                '/' + self.task_config['task_output_prefix'] +
-                                "\" --recursive")
-        self.logger.info("moving data to S3 with command: \n" + upload_result_command)
-        os.system(upload_result_command)
         self.logger.info(os.listdir(self.app_config['TASK_OUTPUT_DIR']))
+        timings = self.task_config['timings']
+        phase_start = time.time()
+        try:
+            self.upload_results(self.app_config['TASK_OUTPUT_DIR'],
+                                self.task_config['run_record_bucket'],
+                                self.task_config['task_output_prefix'])
+        finally:
+            timings['upload'] = time.time() - phase_start
+            phase_start = time.time()
+            self.clear_output_dir()
+            self.release_mount()
+            self.release_staged_images(self.task_config)
+            timings['cleanup'] = time.time() - phase_start
+
+    # remove the output of the last task or batch, the next one writes into the same dir
+    def clear_output_dir(self):
+        output_dir = self.app_config['TASK_OUTPUT_DIR']
+        if len(os.listdir(output_dir)) != 0:
+            self.logger.info("removing " + str(os.listdir(output_dir)))
+            os.system('rm -r ' + output_dir + '/*')
+
+    # count the images of the task and their bytes, from the file list CellProfiler read
+    def measure_images(self):
+        image_count = 0
+        image_bytes = 0
+        with open_csv(self.task_config['image_list_local_copy'], 'r') as f:
+            reader = csv.reader(f)
+            url_columns = [i for i, title in enumerate(next(reader, [])) if title.startswith('URL_')]
+            for row in reader:
+                for i in url_columns:
+                    if not row[i].startswith('file:'):
+                        continue
+                    image_count += 1
+                    try:
+                        image_bytes += os.path.getsize(row[i][len('file:'):])
+                    except OSError:
+                        pass
+        self.task_config['image_count'] = image_count
+        self.task_config['image_bytes'] = image_bytes
+
+    # send the timings and image counts of the task as a metric record
+    # args:
+    #   - result: "finished", or "returned" if the task goes back to the queue
+    def emit_task_metrics(self, result):
+        timings = self.task_config['timings']
+        self.logger.info("task timings: " + str(dict((phase, round(seconds, 3))
+                                                     for phase, seconds in timings.items())))
+
+        metrics = dict((phase + '_seconds', (round(seconds, 3), 'Seconds'))
+                       for phase, seconds in timings.items())
+        metrics['image_count'] = (self.task_config['image_count'], 'Count')
+        metrics['image_bytes'] = (self.task_config['image_bytes'], 'Bytes')
+        properties = {
+            'run_id': self.task_config['run_id'],
+            'task_id': self.task_config['task_id'],
+            'slot': self.slot_id,
+            'batch_size': self.task_config['batch_size'],
+            'result': result
+        }
+        self.worker.metrics_logger.info(json.dumps(build_metric_record(
+            self.app_config['METRICS_NAMESPACE'], metrics, properties)))
 
-        if len(os.listdir(self.app_config['TASK_OUTPUT_DIR'])) != 0:
-            os.system('rm -r ' + self.app_config['TASK_OUTPUT_DIR'] + '/*')
-        os.system("umount " + self.app_config['IMAGE_DATA_BUCKET_DIR'])
+    # upload the files under output_dir to the_prefix, keeping their relative paths
+    # all files are uploaded at once through the transfer manager shared by the slots,
+    # large files in parts. A file is deleted after its size and ETag in S3 are checked
+    def upload_results(self, output_dir, the_bucket, the_prefix):
+        if the_prefix[-1:] != '/':
+            the_prefix = the_prefix + '/'
+
+        start = time.time()
+        uploads = []
+        for dirpath, dirnames, filenames in os.walk(output_dir):
+            for filename in filenames:
+                local_copy = os.path.join(dirpath, filename)
+                the_key = the_prefix + os.path.relpath(local_copy, output_dir).replace(os.sep, '/')
+                future = self.worker.transfer_manager.upload(local_copy, the_bucket, the_key)
+                uploads.append((local_copy, the_key, future))
+
+        num_bytes = 0
+        failed = []
+        for local_copy, the_key, future in uploads:
+            try:
+                size = os.path.getsize(local_copy)
+                # computed while the uploads are in flight
+                etag = get_local_etag(local_copy, self.worker.transfer_config)
+                future.result()
+                self.confirm_upload(the_bucket, the_key, size, etag)
+            except Exception as e:
+                failed.append((the_key, repr(e)))
+                continue
+            os.remove(local_copy)
+            num_bytes += size
+
+        seconds = time.time() - start
+        self.logger.info("uploaded " + str(len(uploads) - len(failed)) + " files, " +
+                         str(num_bytes) + " bytes in " + str(round(seconds, 2)) + " seconds, " +
+                         str(round(num_bytes / 1024.0 / 1024.0 / max(seconds, 0.001), 2)) + " MB/s")
+        if failed:
+            raise RuntimeError("Failed to upload " + str(len(failed)) + " files: " + str(failed))
+
+    # check the uploaded object against the local file
+    def confirm_upload(self, the_bucket, the_key, size, etag):
+        response = self.s3_client.head_object(Bucket=the_bucket, Key=the_key)
+        if response['ContentLength'] != size:
+            raise ValueError("Uploaded size " + str(response['ContentLength']) +
+                             " does not match the local size " + str(size))
+        if self.app_config['UPLOAD_VERIFY_ETAG'] and response['ETag'] != etag:
+            raise ValueError("Uploaded ETag " + response['ETag'] +
+                             " does not match the local checksum " + etag)
 
 
     # construct CellProfiler run command
@@ -230,36 +1366,77 @@ class CpWorker():
         return cp_run_command
 
 
-    # update task status
-    def update_task_status(self, status):
-        task_table = boto3.resource('dynamodb').Table(self.task_config['task_table'])
+    # update task status to finished, with the timings and image counts of the task so far,
+    # and take the task off the remaining-task counter of the run, set by the dispatcher.
+    # both are written in one transaction, so a task is counted exactly once even if the worker
+    # stops in between or its message is delivered twice
+    # returns False if the task was finished already
+    def mark_task_finished(self):
+        status = self.task_status['FINISHED']
+        # dynamodb takes no floats
+        phase_seconds = dict((phase, Decimal(str(round(seconds, 3))))
+                             for phase, seconds in self.task_config['timings'].items())
+        # the client takes typed attribute values
+        serializer = TypeSerializer()
+        def typed(values):
+            return dict((name, serializer.serialize(value)) for name, value in values.items())
 
-        # update status
-        response = task_table.update_item(
-            Key={
-                'run_id': self.task_config['run_id'],
-                'task_id': self.task_config['task_id']
-            },
-            UpdateExpression="set the_status = :new_status",
-            ExpressionAttributeValues={':new_status': status},
-            ReturnValues="ALL_NEW")
+        try:
+            aws_clients.get_client('dynamodb').transact_write_items(TransactItems=[
+                {'Update': {
+                    'TableName': self.task_config['task_table'],
+                    'Key': typed({
+                        'run_id': self.task_config['run_id'],
+                        'task_id': self.task_config['task_id']
+                    }),
+                    'UpdateExpression': ("set the_status = :new_status, phase_seconds = :phase_seconds, "
+                                         "image_count = :image_count, image_bytes = :image_bytes"),
+                    'ConditionExpression': "the_status <> :new_status",
+                    'ExpressionAttributeValues': typed({
+                        ':new_status': status,
+                        ':phase_seconds': phase_seconds,
+                        ':image_count': self.task_config['image_count'],
+                        ':image_bytes': self.task_config['image_bytes']
+                    })
+                }},
+                {'Update': {
+                    'TableName': self.task_config['run_table'],
+                    'Key': typed(self.run_key()),
+                    'UpdateExpression': "ADD remaining_tasks :minus_one",
+                    'ExpressionAttributeValues': typed({':minus_one': -1})
+                }}
+            ])
+        except ClientError as e:
+            # one reason per item, the first item is the task
+            reasons = [x.get('Code') for x in e.response.get('CancellationReasons', [])]
+            if (e.response['Error']['Code'] == 'TransactionCanceledException' and
+                    reasons[:1] == ['ConditionalCheckFailed']):
+                self.logger.info("task status is " + status + " already")
+                return False
+            raise e
+        return True
 
-    # update run status
+    def run_key(self):
+        return {
+            'user_id': self.task_config['user_id'],
+            'submit_date': self.task_config['submit_date']
+        }
+
+    # update run status, after mark_task_finished took the task off the remaining-task counter
     # actions includes:
     #   - update run status to "running" if it is till in "scheduled"
-    #   - if all tasks are done, update runs status to "finished" with conditional writing
+    #   - if no task is remaining, update runs status to "finished" with conditional writing
     #   - if status update succeed, push task to the result consolidataion queue
     #   - the conditional writing ensure only one task will be pushed per run
     def update_run_status(self):
-        run_table = boto3.resource('dynamodb').Table(self.task_config['run_table'])
+        # boto3 resources are not thread safe, every slot thread gets its own
+        run_table = aws_clients.get_resource('dynamodb').Table(self.task_config['run_table'])
+        run_key = self.run_key()
 
         # update run status to running if it is not yet
         try:
             run_table.update_item(
-                Key={
-                    'user_id': self.task_config['user_id'],
-                    'submit_date': self.task_config['submit_date']
-                },
+                Key=run_key,
                 UpdateExpression="set the_status = :new_status",
                 ConditionExpression="the_status = :current_status",
                 ExpressionAttributeValues={
@@ -271,15 +1448,36 @@ class CpWorker():
             pass
 
         # check if the whole run is done
-        # if is_run_finished():
-        if True:
-            self.logger.info(
-                'All the tasks from this run has been done. prepare for result consolidation.')
-            message = self.build_result_consolidation_message()
-            reslut_consolidation_queue = JobQueue(
-                self.task_config['result_consolidation_queue_url'])
-            reslut_consolidation_queue.enqueueMessage(message)
-            self.logger.info("run result consolidation task pushed to the queue")
+        response = run_table.get_item(
+            Key=run_key,
+            ProjectionExpression="remaining_tasks",
+            ConsistentRead=True)
+        remaining_tasks = response['Item']['remaining_tasks']
+        self.logger.info(str(remaining_tasks) + " tasks remaining in the run")
+        if remaining_tasks != 0:
+            return
+
+        try:
+            run_table.update_item(
+                Key=run_key,
+                UpdateExpression="set the_status = :new_status",
+                ConditionExpression="remaining_tasks = :zero AND the_status <> :new_status",
+                ExpressionAttributeValues={
+                    ':new_status': self.run_status['FINISHED'],
+                    ':zero': 0
+                })
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return
+            raise e
+
+        self.logger.info(
+            'All the tasks from this run has been done. prepare for result consolidation.')
+        message = self.build_result_consolidation_message()
+        reslut_consolidation_queue = self.worker.get_queue(
+            self.task_config['result_consolidation_queue_url'])
+        reslut_consolidation_queue.enqueueMessage(message)
+        self.logger.info("run result consolidation task pushed to the queue")
 
 
     # function to build result consolidation task message
@@ -294,24 +1492,56 @@ class CpWorker():
         return the_message
 
 
-    # check if run is finished, disregard if there is error or not
-    # criteria: if no task is in "scheduled" status, then it is done.
-    def is_run_finished(self):
-        task_table = boto3.resource('dynamodb').Table(self.task_config['task_table'])
+# receive and stage the next task in the background while the current task runs
+# the prefetched message is kept invisible by the heartbeat, see fetch_task. Without a heartbeat
+# it is held until the slot claims it, then it gets the queue's full visibility timeout,
+# like a message just received
+class TaskPrefetcher(threading.Thread):
+    def __init__(self, slot, input_dir):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.slot = slot
+        self.input_dir = input_dir
+        self.task = None
+        self.error = None
+        self.claimed = threading.Event()
 
-        # get tasks status
-        response = task_table.query(
-            KeyConditionExpression=Key('run_id').eq(self.task_config['run_id']))
+    def run(self):
+        try:
+            if os.path.isdir(self.input_dir):
+                shutil.rmtree(self.input_dir)
+            self.task = self.slot.fetch_task(self.input_dir)
+        except Exception as e:
+            self.error = e
+            return
 
-        tasks_status = [x['the_status'] for x in response['Items']]
+        if self.task is None:
+            return
+        print("prefetched task " + self.task['task_config']['task_id'])
 
-        # show the overall status of the run
-        logger.info(dict(Counter(tasks_status)))
+        task_queue = self.slot.task_queue
+        if task_queue.heartbeat is not None:
+            return
+        task_queue.extendMessage(self.task['handle'], PREFETCH_HOLD_SECONDS)
+        while not self.claimed.wait(PREFETCH_HOLD_SECONDS / 2):
+            task_queue.extendMessage(self.task['handle'], PREFETCH_HOLD_SECONDS)
 
-        if self.task_status['SCHEDULED'] in tasks_status:
-            return False
-        else:
-            return True
+    # stop holding the message and hand the task over, None if nothing was prefetched
+    def claim(self):
+        if self.ident is None:
+            # never started
+            return None
+        self.claimed.set()
+        self.join()
+        if self.error is not None:
+            # the message, if any, was returned to the queue by fetch_task
+            self.slot.logger.info("prefetching next task failed: " + repr(self.error))
+            return None
+        if self.task is not None and self.slot.task_queue.heartbeat is None:
+            self.slot.task_queue.extendMessage(self.task['handle'],
+                                               self.slot.task_visibility_timeout)
+            self.task['visible_at'] = time.time() + self.slot.task_visibility_timeout
+        return self.task
 
 
 # Entry point
@@ -2,6 +2,16 @@
 # resuable for other part of our app
 
 import boto3
+import io
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 
 # get list if directories / flies in current "directory"
 # args:
@@ -12,6 +22,23 @@ import boto3
 
 
 def get_content_in_dir(s3_client, the_bucket, the_prefix, recursive=False, max_items=None):
+    # get dir or file list
+    content = {'dirs': [], 'files': []}
+    for response in iter_list_pages(s3_client, the_bucket, the_prefix, recursive, max_items):
+        if 'CommonPrefixes' in response.keys():
+            for item in response['CommonPrefixes']:
+                content['dirs'].append(item['Prefix'])
+
+        if 'Contents' in response.keys():
+            for item in response['Contents']:
+                content['files'].append(item['Key'])
+
+    return content
+
+
+# page through the content of a "directory", yield the list_objects_v2 responses as they arrive
+# args: same as get_content_in_dir
+def iter_list_pages(s3_client, the_bucket, the_prefix, recursive=False, max_items=None):
     # check if prefix has "/" at the end, if not, add one
     if the_prefix[-1:] != '/':
         the_valid_prefix = the_prefix + '/'
@@ -29,25 +56,92 @@ def get_content_in_dir(s3_client, the_bucket, the_prefix, recursive=False, max_i
     if not max_items is None:
         kwargs['MaxKeys'] = max_items
 
-    # get dir or file list
-    content = {'dirs': [], 'files': []}
     while True:
         response = s3_client.list_objects_v2(**kwargs)
-
-        if 'CommonPrefixes' in response.keys():
-            for item in response['CommonPrefixes']:
-                content['dirs'].append(item['Prefix'])
-
-        if 'Contents' in response.keys():
-            for item in response['Contents']:
-                content['files'].append(item['Key'])
+        yield response
 
         try:
             kwargs['ContinuationToken'] = response['NextContinuationToken']
         except KeyError:
             break
 
-    return content
+
+# yield the keys of the files in current "directory" as the listing goes,
+# so callers can filter lazily and stop early
+# args:
+#   - s3_client: a boto3 s3 client to work on S3 bucket
+#   - the_bucket: the bucket to work on
+#   - the_prefix: the prefix to the target directory
+#   - recursive: include files in sub directories
+def iter_files_in_dir(s3_client, the_bucket, the_prefix, recursive=False):
+    for item in iter_objects_in_dir(s3_client, the_bucket, the_prefix, recursive):
+        yield item['Key']
+
+
+# same as iter_files_in_dir, yielding the listing entries of the files: Key, ETag, Size, ...
+def iter_objects_in_dir(s3_client, the_bucket, the_prefix, recursive=False):
+    for response in iter_list_pages(s3_client, the_bucket, the_prefix, recursive):
+        for item in response.get('Contents', []):
+            yield item
+
+
+# yield the keys of all the files under current "directory", listing each sub directory
+# in parallel. Meant for wide trees like the "sub_tasks" dir of a run, one sub directory per task.
+# keys come in no particular order. Listing stops when the caller stops reading.
+# args:
+#   - s3_client: a boto3 s3 client to work on S3 bucket
+#   - the_bucket: the bucket to work on
+#   - the_prefix: the prefix to the target directory
+#   - max_workers: number of sub directories listed at the same time
+def iter_files_in_sub_dirs(s3_client, the_bucket, the_prefix, max_workers=8):
+    results = queue.Queue(maxsize=max_workers * 4)
+    stop = threading.Event()
+
+    # hand over to the caller, give up if the caller is gone
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def list_sub_dir(sub_prefix):
+        try:
+            for response in iter_list_pages(s3_client, the_bucket, sub_prefix, True):
+                if stop.is_set():
+                    break
+                put(('keys', [x['Key'] for x in response.get('Contents', [])]))
+        except Exception as e:
+            put(('error', e))
+        finally:
+            put(('done', None))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = []
+    try:
+        # files right under the prefix are yielded here, each sub directory gets its own listing
+        for response in iter_list_pages(s3_client, the_bucket, the_prefix):
+            for item in response.get('CommonPrefixes', []):
+                futures.append(executor.submit(list_sub_dir, item['Prefix']))
+            for item in response.get('Contents', []):
+                yield item['Key']
+
+        pending = len(futures)
+        while pending:
+            kind, value = results.get()
+            if kind == 'done':
+                pending -= 1
+            elif kind == 'error':
+                raise value
+            else:
+                for key in value:
+                    yield key
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
 
 
 # check if certain file type exists in current dir
@@ -57,20 +151,27 @@ def get_content_in_dir(s3_client, the_bucket, the_prefix, recursive=False, max_i
 #   - s3_client: a boto3 s3 client to work on S3 bucket
 #   - the_bucket: the bucket to work on
 #   - the_prefix: the prefix to the target directory. Must have "/" at the end
-def find_by_extension(s3_client, the_bucket, the_prefix, file_extension):
+#   - max_results: stop listing once this many files are found, by default list everything
+def find_by_extension(s3_client, the_bucket, the_prefix, file_extension, max_results=None):
+    return [item['Key'] for item in find_objects_by_extension(
+        s3_client, the_bucket, the_prefix, file_extension, max_results)]
+
+
+# same as find_by_extension, returning the listing entries of the files: Key, ETag, Size, ...
+def find_objects_by_extension(s3_client, the_bucket, the_prefix, file_extension, max_results=None):
     # check if prefix has "/" at the end, if not, add one
     if the_prefix[-1:] != '/':
         the_valid_prefix = the_prefix + '/'
     else:
         the_valid_prefix = the_prefix
 
-    content = get_content_in_dir(s3_client, the_bucket, the_valid_prefix)
-
     target_files = []
 
-    for item in content['files']:
-        if item.split('.')[-1] == file_extension:
+    for item in iter_objects_in_dir(s3_client, the_bucket, the_valid_prefix):
+        if item['Key'].split('.')[-1] == file_extension:
             target_files.append(item)
+            if len(target_files) == max_results:
+                break
 
     return target_files
 
@@ -94,6 +195,68 @@ def download_file(s3_client, the_bucket, the_key, destination):
     return saved_as
 
 
+# download files in parallel and hand them over one by one, in the order of the keys,
+# so the caller works on a file while the next ones are downloading.
+# up to max_workers * 2 files are downloaded ahead of the caller
+#   args:
+#   - s3_client: a boto3 s3 client to work on S3 bucket
+#   - the_bucket: the s3 bucket where the files are stored
+#   - keys: the keys of the files to download
+#   - max_workers: number of files downloaded at the same time
+#   - spool_dir: save the files in this directory, by default they are kept in memory,
+#     up to max_workers * 2 whole files at a time
+#   - yields (key, file object open for reading). the file object is only good until the next
+#     one is asked for, a spooled file is removed then
+
+def iter_downloads(s3_client, the_bucket, keys, max_workers=8, spool_dir=None):
+    def download(index, the_key):
+        if spool_dir is None:
+            data = io.BytesIO()
+            s3_client.download_fileobj(the_bucket, the_key, data)
+            data.seek(0)
+            return data
+        # files of different tasks have the same name
+        saved_as = os.path.join(spool_dir, str(index) + '_' + the_key.split('/')[-1])
+        try:
+            with open(saved_as, 'wb') as data:
+                s3_client.download_fileobj(the_bucket, the_key, data)
+        except Exception:
+            # keep the error of the download
+            try:
+                os.remove(saved_as)
+            except OSError:
+                pass
+            raise
+        return saved_as
+
+    keys = list(keys)
+    ahead = max_workers * 2
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = deque(executor.submit(download, i, keys[i]) for i in range(min(ahead, len(keys))))
+    try:
+        for index, the_key in enumerate(keys):
+            downloaded = futures.popleft().result()
+            if index + ahead < len(keys):
+                futures.append(executor.submit(download, index + ahead, keys[index + ahead]))
+            if spool_dir is None:
+                yield the_key, downloaded
+                continue
+            try:
+                with open(downloaded, 'rb') as data:
+                    yield the_key, data
+            finally:
+                os.remove(downloaded)
+    finally:
+        # the caller stopped early or a download failed, drop what was downloaded ahead
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if spool_dir is not None:
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    os.remove(future.result())
+
+
 # upload file from s3 to local storge
 #   args:
 #   - s3_client: a boto3 s3 client to work on S3 bucket
@@ -110,6 +273,76 @@ def upload_file(s3_client, path_to_file, the_bucket, the_key):
         raise e
 
 
+# upload in-memory content to s3, no local file involved
+#   args:
+#   - s3_client: a boto3 s3 client to work on S3 bucket
+#   - content: the bytes (or string) to save as the file
+#   - the_bucket: the s3 bucket to save the file
+#   - the_key:   the key of the file, decide where the file goes in the bucket
+
+def upload_content(s3_client, content, the_bucket, the_key):
+    s3_client.put_object(Bucket=the_bucket, Key=the_key, Body=content)
+
+
+# write a file to s3 as a stream of bytes, no local file involved
+# the bytes are sent in parts of a multipart upload, so only one part is held in memory.
+# a file smaller than a part is saved with a single put_object.
+# call complete when done, or abort to drop the parts sent so far
+#   args:
+#   - s3_client: a boto3 s3 client to work on S3 bucket
+#   - the_bucket: the s3 bucket to save the file
+#   - the_key:   the key of the file, decide where the file goes in the bucket
+#   - part_size: bytes per part, S3 takes no part under 5 MB except the last one
+
+class StreamingUpload():
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, s3_client, the_bucket, the_key, part_size=MIN_PART_SIZE):
+        self.s3_client = s3_client
+        self.the_bucket = the_bucket
+        self.the_key = the_key
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+        if self.buffered_bytes >= self.part_size:
+            self.upload_part()
+
+    def upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.the_bucket, Key=self.the_key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.the_bucket, Key=self.the_key,
+                                              UploadId=self.upload_id, PartNumber=part_number,
+                                              Body=b''.join(self.buffer))
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def complete(self):
+        if self.upload_id is None:
+            upload_content(self.s3_client, b''.join(self.buffer), self.the_bucket, self.the_key)
+            self.buffer = []
+            return
+        if self.buffered_bytes > 0:
+            self.upload_part()
+        self.s3_client.complete_multipart_upload(Bucket=self.the_bucket, Key=self.the_key,
+                                                 UploadId=self.upload_id,
+                                                 MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.the_bucket, Key=self.the_key,
+                                                  UploadId=self.upload_id)
+        self.buffer = []
+
+
 # # quick test
 # bucket = 'hca-cloud-native'
 # prefix = 'example_data/'
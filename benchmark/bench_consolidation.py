@@ -0,0 +1,105 @@
+# benchmark of the result consolidation of the post run processor
+# consolidates a synthetic run, one object table per task, from the in-process fakes in fake_aws.py
+# with the streaming mode, reporting wall time, API calls and the peak RSS on top of the fake bucket
+# for a number of download workers, with the downloads held in memory or spooled to disk.
+# the peak RSS includes the consolidated file, which the fake bucket keeps in memory.
+# (the pandas mode clears /tmp when done, so it is not run here)
+# each measurement runs in its own process, so the peak RSS of one case does not leak into another.
+#
+# usage:
+#   python benchmark/bench_consolidation.py [--tasks 384] [--rows 2000] [--workers 1 8 32]
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BENCHMARK_DIR)
+sys.path.append(os.path.join(BENCHMARK_DIR, '..', 'post_run_processor_docker_image'))
+
+import fake_aws
+
+RUN_RECORD_BUCKET = 'hca-cloud-native'
+SUB_TASK_PREFIX = 'run_history/benchmark/sub_tasks/'
+FINAL_OUTPUT_PREFIX = 'run_history/benchmark/consolidated/'
+
+
+# an object table of a task, like CellProfiler writes it
+def build_object_table(task_index, num_rows, num_columns):
+    header = ['ImageNumber', 'ObjectNumber'] + ['Measurement_' + str(i) for i in range(num_columns)]
+    lines = [','.join(header)]
+    for row in range(num_rows):
+        values = [str(row // 10 + 1), str(row % 10 + 1)]
+        values.extend('%.6f' % ((task_index + row * i) % 1000 / 7.0) for i in range(num_columns))
+        lines.append(','.join(values))
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+# run one measurement, called in a child process
+def measure(args, workers, spool):
+    os.environ['RESULT_CONSOLIDATION_QUEUE_URL'] = 'https://sqs.fake/HCA-result-consolidation'
+    aws = fake_aws.FakeAWS({'s3': args.s3_latency})
+    aws.install()
+    import aws_clients
+    import post_run_processor
+
+    for i in range(args.tasks):
+        aws.s3.add_object(RUN_RECORD_BUCKET, SUB_TASK_PREFIX + 'task_' + str(i) + '/output/Nuclei.csv',
+                          build_object_table(i, args.rows, args.columns))
+
+    spool_dir = tempfile.mkdtemp() if spool else None
+    post_run_processor.app_config.update({'consolidation_mode': 'stream', 'download_workers': workers,
+                                          'download_spool_dir': spool_dir})
+    s3 = aws_clients.get_client('s3')
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    aws.reset_counts()
+    start = time.time()
+    groups = post_run_processor.get_result_files(s3, RUN_RECORD_BUCKET, SUB_TASK_PREFIX, 'Experiment.csv')
+    post_run_processor.consolidate_and_upload_streaming(s3, groups, RUN_RECORD_BUCKET, FINAL_OUTPUT_PREFIX)
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if spool_dir:
+        shutil.rmtree(spool_dir)
+
+    output_mb = len(aws.s3.objects[(RUN_RECORD_BUCKET, FINAL_OUTPUT_PREFIX + 'combined_Nuclei.csv')]) / 1024.0 / 1024.0
+    # ru_maxrss is in KB on linux
+    print(json.dumps({'seconds': elapsed, 'output_mb': output_mb, 'calls': aws.call_counts(),
+                      'consolidation_rss_mb': (peak_rss - baseline_rss) / 1024.0}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark result consolidation')
+    parser.add_argument('--tasks', type=int, default=384)
+    parser.add_argument('--rows', type=int, default=2000, help='rows of the object table of a task')
+    parser.add_argument('--columns', type=int, default=20, help='measurement columns of the object table')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--s3-latency', type=float, default=fake_aws.DEFAULT_LATENCY['s3'])
+    parser.add_argument('--child', nargs=2, metavar=('WORKERS', 'SPOOL'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args, int(args.child[0]), args.child[1] == 'spool')
+        return
+
+    print('%-8s %-9s %10s %10s %10s %18s' %
+          ('workers', 'downloads', 'output_mb', 'seconds', 'get_calls', 'consolidation_rss'))
+    for workers in args.workers:
+        for spool in ['memory', 'spool']:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--tasks', str(args.tasks),
+                 '--rows', str(args.rows), '--columns', str(args.columns),
+                 '--s3-latency', str(args.s3_latency), '--child', str(workers), spool])
+            result = json.loads(output.decode().strip().split('\n')[-1])
+            print('%-8d %-9s %10.1f %10.2f %10d %18.1f' %
+                  (workers, spool, result['output_mb'], result['seconds'],
+                   result['calls'].get('s3.get_object', 0), result['consolidation_rss_mb']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+# offline throughput benchmark of the job dispatcher
+# drives job_dispatcher against the in-process fakes in fake_aws.py on synthetic plates.
+#
+# two measurements per plate:
+#   - phases: listing, parsing, csv generation, upload, db write and enqueue are run one after
+#             another with the dispatcher's own functions, reporting wall time, API calls and
+#             peak traced memory of each phase (memory tracing slows the phases down a little)
+#   - submit_run: the real end to end submission, reporting wall time and API calls
+# with --plates N, the plate is also submitted N times at once through submit_runs.
+#
+# usage:
+#   python benchmark/bench_dispatcher.py [--wells 96 384] [--s3-latency 0.02] [--json result.json]
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BENCHMARK_DIR)
+sys.path.append(os.path.join(BENCHMARK_DIR, '..'))
+sys.path.append(os.path.join(BENCHMARK_DIR, '..', 'job_dispatcher'))
+
+import fake_aws
+import synthetic_plate
+import job_dispatcher
+from libs import aws_clients
+from libs import s3worker
+from libs.JobQueue import JobQueue
+
+IMAGE_BUCKET = 'hca-cloud-native'
+IMAGE_PREFIX = 'example_data/'
+RUN_RECORD_BUCKET = 'hca-cloud-native'
+TASK_QUEUE_URL = 'https://sqs.fake/HCA-tasks'
+
+
+# put a synthetic plate into the fake bucket: the metadata file and an empty object per image
+def setup_plate(aws, work_dir, num_wells, args):
+    metadata_file = os.path.join(work_dir, 'plate_' + str(num_wells) + '.xdce')
+    image_count = synthetic_plate.write_xdce(metadata_file, num_wells, args.fields,
+                                             args.channels, args.planes)
+    with open(metadata_file, 'rb') as f:
+        aws.s3.add_object(IMAGE_BUCKET, IMAGE_PREFIX + 'plate.xdce', f.read())
+    os.remove(metadata_file)
+
+    for image in synthetic_plate.iter_images(num_wells, args.fields, args.channels, args.planes):
+        aws.s3.add_object(IMAGE_BUCKET, IMAGE_PREFIX + image[-1], b'')
+
+    return image_count
+
+
+def build_run_request(run_id, args):
+    return {
+        "user_id": "benchmark",
+        "submit_date": str(int(round(time.time() * 1000))),
+        "run_id": run_id,
+        "run_description": "dispatcher benchmark",
+        "the_status": "Scheduled",
+        "task_queue_url": TASK_QUEUE_URL,
+        "result_consolidation_queue_url": TASK_QUEUE_URL + "-consolidation",
+        "run_table": "runs",
+        "task_table": "tasks",
+        "image_data": {
+            "s3_bucket": IMAGE_BUCKET,
+            "prefix": IMAGE_PREFIX,
+            "metadata_file_extention": "xdce"
+        },
+        "pipeline_file": {
+            "s3_bucket": IMAGE_BUCKET,
+            "key": "pipeline_files/test.cppipe"
+        },
+        "run_record_location": {
+            "s3_bucket": RUN_RECORD_BUCKET,
+            "prefix": "run_history/"
+        },
+        "task_packing": {"mode": args.packing, "size": args.packing_size}
+    }
+
+
+class PhaseRecorder():
+    def __init__(self, aws):
+        self.aws = aws
+        self.results = []
+
+    def run(self, name, function):
+        self.aws.reset_counts()
+        tracemalloc.start()
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.results.append({'phase': name, 'seconds': elapsed,
+                             'peak_mb': peak / 1024.0 / 1024.0,
+                             'calls': self.aws.call_counts()})
+        return result
+
+
+# run the submission steps one by one with the dispatcher's functions
+def measure_phases(aws, work_dir, run_request, args):
+    s3 = aws.s3
+    phases = PhaseRecorder(aws)
+
+    metadata_files = phases.run('listing', lambda: s3worker.find_by_extension(
+        s3, IMAGE_BUCKET, IMAGE_PREFIX, 'xdce'))
+
+    def parse():
+        local_copy = s3worker.download_file(s3, IMAGE_BUCKET, metadata_files[0], work_dir)
+        return list(job_dispatcher.parse_metadata_file(local_copy, IMAGE_PREFIX))
+    rows = phases.run('parsing', parse)
+
+    task_template = job_dispatcher.build_task_template(run_request)
+
+    def generate_csv():
+        return [(job_dispatcher.build_task(task_template, task_id),
+                 job_dispatcher.render_csv(rows_for_task))
+                for task_id, rows_for_task in job_dispatcher.pack_tasks(rows, run_request['task_packing'])]
+    tasks = phases.run('csv generation', generate_csv)
+
+    def upload():
+        with ThreadPoolExecutor(max_workers=job_dispatcher.UPLOAD_WORKERS) as uploader:
+            list(uploader.map(lambda x: s3worker.upload_content(
+                s3, x[1], RUN_RECORD_BUCKET, x[0]['file_list_key']), tasks))
+    phases.run('upload', upload)
+
+    task_table = aws.dynamodb.Table(run_request['task_table'])
+    phases.run('db write', lambda: job_dispatcher.batch_put_items(
+        task_table, [x[0] for x in tasks]))
+
+    phases.run('enqueue', lambda: JobQueue(TASK_QUEUE_URL).enqueueMessages(
+        [x[0] for x in tasks], max_workers=job_dispatcher.ENQUEUE_WORKERS))
+
+    return phases.results, len(tasks)
+
+
+def measure_submit_run(aws, run_request):
+    aws.reset_counts()
+    start = time.time()
+    job_dispatcher.submit_run(run_request)
+    return {'seconds': time.time() - start, 'calls': aws.call_counts()}
+
+
+def measure_submit_runs(aws, num_wells, args):
+    aws.reset_counts()
+    run_requests = [build_run_request('batch_' + str(num_wells) + '_' + str(i), args)
+                    for i in range(args.plates)]
+    start = time.time()
+    summaries = job_dispatcher.submit_runs(run_requests, max_workers=args.plate_workers)
+    return {'seconds': time.time() - start, 'calls': aws.call_counts(),
+            'plate_seconds': [x['seconds'] for x in summaries],
+            'errors': [x['error'] for x in summaries if x['error']]}
+
+
+def total_calls(calls):
+    return sum(calls.values())
+
+
+def print_report(report):
+    print('')
+    print('plate: ' + str(report['wells']) + ' wells, ' + str(report['images']) + ' images, ' +
+          str(report['tasks']) + ' tasks')
+    print('%-16s %10s %10s %10s  %s' % ('phase', 'seconds', 'peak_mb', 'api_calls', 'calls'))
+    for phase in report['phases']:
+        print('%-16s %10.3f %10.1f %10d  %s' % (phase['phase'], phase['seconds'], phase['peak_mb'],
+                                              total_calls(phase['calls']), phase['calls']))
+    submit = report['submit_run']
+    print('%-16s %10.3f %10s %10d  %s' % ('submit_run', submit['seconds'], '-',
+                                        total_calls(submit['calls']), submit['calls']))
+    if 'submit_runs' in report:
+        batch = report['submit_runs']
+        print('%-16s %10.3f %10s %10d  %s' % ('submit_runs x' + str(len(batch['plate_seconds'])),
+                                            batch['seconds'], '-', total_calls(batch['calls']),
+                                            'slowest plate: %.3f s, errors: %s' %
+                                            (max(batch['plate_seconds']), batch['errors'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offline job dispatcher benchmark')
+    parser.add_argument('--wells', type=int, nargs='+', default=[96, 384, 1536],
+                        choices=sorted(synthetic_plate.PLATE_LAYOUTS.keys()))
+    parser.add_argument('--fields', type=int, default=9)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--planes', type=int, default=1)
+    parser.add_argument('--packing', default='per_well',
+                        choices=sorted(job_dispatcher.TASK_PACKERS.keys()))
+    parser.add_argument('--packing-size', type=int, default=None)
+    parser.add_argument('--s3-latency', type=float, default=fake_aws.DEFAULT_LATENCY['s3'])
+    parser.add_argument('--sqs-latency', type=float, default=fake_aws.DEFAULT_LATENCY['sqs'])
+    parser.add_argument('--dynamodb-latency', type=float, default=fake_aws.DEFAULT_LATENCY['dynamodb'])
+    parser.add_argument('--plates', type=int, default=1,
+                        help='also submit this many copies of the plate at once with submit_runs')
+    parser.add_argument('--plate-workers', type=int, default=8)
+    parser.add_argument('--json', help='also save the report to this file')
+    args = parser.parse_args()
+
+    reports = []
+    for num_wells in args.wells:
+        aws = fake_aws.FakeAWS({'s3': args.s3_latency, 'sqs': args.sqs_latency,
+                                'dynamodb': args.dynamodb_latency})
+        work_dir = tempfile.mkdtemp()
+        # keep the metadata cache of every plate apart, so submit_run always parses
+        os.environ['METADATA_CACHE_DIR'] = os.path.join(work_dir, 'metadata_cache')
+        job_dispatcher.metadata_cache = None
+
+        aws.install()
+        # drop the clients of the previous plate's fakes
+        aws_clients.reset()
+        try:
+            image_count = setup_plate(aws, work_dir, num_wells, args)
+            phases, num_tasks = measure_phases(
+                aws, work_dir, build_run_request('phases_' + str(num_wells), args), args)
+            submit = measure_submit_run(aws, build_run_request('submit_' + str(num_wells), args))
+            if args.plates > 1:
+                batch = measure_submit_runs(aws, num_wells, args)
+        finally:
+            aws.uninstall()
+            shutil.rmtree(work_dir)
+
+        report = {'wells': num_wells, 'images': image_count, 'tasks': num_tasks,
+                  'phases': phases, 'submit_run': submit}
+        if args.plates > 1:
+            report['submit_runs'] = batch
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# benchmark for parsing ".xdce" metadata files in the job dispatcher
+# reports parse time and peak RSS for synthetic 96-, 384- and 1536-well plates,
+# comparing the streaming parser with a full-tree parse of the same file.
+# the streaming parser drops the elements as it goes but holds every well/field group until
+# the end of the file, so its memory grows with the number of groups, reported per group.
+# each measurement runs in its own process, so the peak RSS of one case does not leak into another.
+#
+# usage:
+#   python benchmark/bench_parse_metadata.py [--fields 9] [--channels 4] [--planes 1]
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BENCHMARK_DIR)
+sys.path.append(os.path.join(BENCHMARK_DIR, '..'))
+sys.path.append(os.path.join(BENCHMARK_DIR, '..', 'job_dispatcher'))
+
+import synthetic_plate
+import job_dispatcher
+
+PLATE_SIZES = [96, 384, 1536]
+MODES = ['streaming', 'full-tree']
+
+
+# the previous approach: build the whole tree, then walk the images
+def parse_full_tree(metadata_file):
+    root = ET.parse(metadata_file).getroot()
+    groups = {}
+    for image in root.iter("Image"):
+        the_well = image.find("Well")
+        group_id = the_well.get("label") + "@" + image.find("Identifier").get("field_index")
+        groups.setdefault(group_id, {})["URL_" + image.find("EmissionFilter").get("name")] = \
+            image.attrib["filename"]
+    return len(groups)
+
+
+def parse_streaming(metadata_file):
+    count = 0
+    for _ in job_dispatcher.parse_metadata_file(metadata_file, "example_data/"):
+        count += 1
+    return count
+
+
+# run one measurement, called in a child process
+def measure(metadata_file, mode):
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if mode == 'streaming':
+        groups = parse_streaming(metadata_file)
+    else:
+        groups = parse_full_tree(metadata_file)
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in KB on linux
+    print(json.dumps({'groups': groups, 'seconds': elapsed,
+                      'peak_rss_mb': peak_rss / 1024.0,
+                      'parse_rss_mb': (peak_rss - baseline_rss) / 1024.0}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark metadata file parsing')
+    parser.add_argument('--fields', type=int, default=9)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--planes', type=int, default=1)
+    parser.add_argument('--child', nargs=2, metavar=('FILE', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.child[0], args.child[1])
+        return
+
+    print('%-6s %-10s %10s %10s %10s %10s %12s %12s' %
+          ('wells', 'mode', 'images', 'file_mb', 'groups', 'seconds', 'parse_rss_mb', 'kb_per_group'))
+    work_dir = tempfile.mkdtemp()
+    for num_wells in PLATE_SIZES:
+        metadata_file = os.path.join(work_dir, 'plate_' + str(num_wells) + '.xdce')
+        images = synthetic_plate.write_xdce(metadata_file, num_wells, args.fields,
+                                            args.channels, args.planes)
+        file_mb = os.path.getsize(metadata_file) / 1024.0 / 1024.0
+        for mode in MODES:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--child', metadata_file, mode])
+            result = json.loads(output.decode().strip().split('\n')[-1])
+            print('%-6d %-10s %10d %10.1f %10d %10.2f %12.1f %12.2f' %
+                  (num_wells, mode, images, file_mb, result['groups'],
+                   result['seconds'], result['parse_rss_mb'],
+                   result['parse_rss_mb'] * 1024.0 / result['groups']))
+        os.remove(metadata_file)
+    os.rmdir(work_dir)
+
+
+if __name__ == '__main__':
+    main()
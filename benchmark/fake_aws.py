@@ -0,0 +1,360 @@
+# in-process stand-ins for the S3, SQS and DynamoDB calls used by the app
+# every call sleeps for the configured latency of its service and is counted,
+# so throughput can be measured without live AWS.
+#
+# usage:
+#   aws = FakeAWS(latency={'s3': 0.02, 'sqs': 0.01, 'dynamodb': 0.01})
+#   aws.install()       # boto3.client / boto3.resource now return the fakes
+#   ...
+#   aws.uninstall()
+#   print(aws.call_counts())
+
+import collections
+import hashlib
+import json
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+DEFAULT_LATENCY = {'s3': 0.02, 'sqs': 0.01, 'dynamodb': 0.01}
+
+# page size of list_objects_v2
+MAX_KEYS = 1000
+LAST_CHARACTER = chr(0x10ffff)
+
+
+class FakeAWS():
+    def __init__(self, latency=None):
+        self.latency = dict(DEFAULT_LATENCY)
+        if latency:
+            self.latency.update(latency)
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+        self.s3 = FakeS3(self)
+        self.sqs = FakeSQS(self)
+        self.dynamodb = FakeDynamoDB(self)
+
+        self.original_client = None
+        self.original_resource = None
+
+    # count the call and wait as long as the real service would
+    def call(self, service, operation):
+        with self.lock:
+            self.calls[service + '.' + operation] += 1
+        time.sleep(self.latency[service])
+
+    def call_counts(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls.clear()
+
+    def client(self, service_name, *args, **kwargs):
+        if service_name == 's3':
+            return self.s3
+        if service_name == 'sqs':
+            return self.sqs
+        if service_name == 'dynamodb':
+            return self.dynamodb.client
+        raise ValueError("No fake for service: " + service_name)
+
+    def resource(self, service_name, *args, **kwargs):
+        if service_name == 'dynamodb':
+            return self.dynamodb
+        raise ValueError("No fake resource for service: " + service_name)
+
+    def install(self):
+        self.original_client = boto3.client
+        self.original_resource = boto3.resource
+        boto3.client = self.client
+        boto3.resource = self.resource
+
+    def uninstall(self):
+        boto3.client = self.original_client
+        boto3.resource = self.original_resource
+
+
+def not_found(operation):
+    return ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, operation)
+
+
+class FakeS3():
+    def __init__(self, aws):
+        self.aws = aws
+        self.objects = {}
+        # parts of the multipart uploads in progress, by upload id
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    # add an object without counting a call, used to set up the bucket
+    def add_object(self, the_bucket, the_key, content):
+        with self.lock:
+            self.objects[(the_bucket, the_key)] = content
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, StartAfter=None,
+                        MaxKeys=MAX_KEYS, ContinuationToken=None):
+        self.aws.call('s3', 'list_objects_v2')
+        with self.lock:
+            keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+
+        start = ContinuationToken or StartAfter
+        if start:
+            keys = [k for k in keys if k > start]
+
+        response = {'KeyCount': 0}
+        contents = []
+        common_prefixes = []
+        last_key = None
+        for key in keys:
+            if len(contents) + len(common_prefixes) >= min(MaxKeys, MAX_KEYS):
+                response['NextContinuationToken'] = last_key
+                break
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common_prefix = Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter
+                if not common_prefixes or common_prefixes[-1]['Prefix'] != common_prefix:
+                    common_prefixes.append({'Prefix': common_prefix})
+                # continue after every key under the common prefix
+                key = common_prefix + LAST_CHARACTER
+            else:
+                contents.append({'Key': key, 'Size': len(self.objects[(Bucket, key)]),
+                                 'ETag': self.etag(Bucket, key)})
+            last_key = key
+
+        if contents:
+            response['Contents'] = contents
+        if common_prefixes:
+            response['CommonPrefixes'] = common_prefixes
+        response['KeyCount'] = len(contents) + len(common_prefixes)
+        return response
+
+    def etag(self, the_bucket, the_key):
+        return '"' + hashlib.md5(self.objects[(the_bucket, the_key)]).hexdigest() + '"'
+
+    def head_object(self, Bucket, Key):
+        self.aws.call('s3', 'head_object')
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise not_found('HeadObject')
+            return {'ETag': self.etag(Bucket, Key),
+                    'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def get_object_content(self, Bucket, Key, operation):
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise not_found(operation)
+            return self.objects[(Bucket, Key)]
+
+    def download_fileobj(self, Bucket, Key, Fileobj, *args, **kwargs):
+        self.aws.call('s3', 'get_object')
+        Fileobj.write(self.get_object_content(Bucket, Key, 'GetObject'))
+
+    def download_file(self, Bucket, Key, Filename, *args, **kwargs):
+        with open(Filename, 'wb') as f:
+            self.download_fileobj(Bucket, Key, f)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.aws.call('s3', 'get_object')
+        content = self.get_object_content(Bucket, Key, 'GetObject')
+        start, end = 0, len(content) - 1
+        if 'Range' in kwargs:
+            start, end = [int(x) for x in kwargs['Range'].split('=')[1].split('-')]
+        return {'Body': FakeStreamingBody(content[start:end + 1]),
+                'ETag': self.etag(Bucket, Key), 'ContentLength': end - start + 1}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.aws.call('s3', 'put_object')
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if not isinstance(Body, bytes):
+            Body = Body.encode('utf-8')
+        self.add_object(Bucket, Key, Body)
+        return {'ETag': self.etag(Bucket, Key)}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, *args, **kwargs):
+        self.put_object(Bucket, Key, Fileobj.read())
+
+    def upload_file(self, Filename, Bucket, Key, *args, **kwargs):
+        with open(Filename, 'rb') as f:
+            self.upload_fileobj(f, Bucket, Key)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.aws.call('s3', 'create_multipart_upload')
+        with self.lock:
+            upload_id = str(len(self.uploads) + 1)
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.aws.call('s3', 'upload_part')
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.aws.call('s3', 'complete_multipart_upload')
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+        self.add_object(Bucket, Key, b''.join(parts[x['PartNumber']] for x in MultipartUpload['Parts']))
+        return {'ETag': self.etag(Bucket, Key)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.aws.call('s3', 'abort_multipart_upload')
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+
+    def delete_object(self, Bucket, Key):
+        self.aws.call('s3', 'delete_object')
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+
+
+class FakeStreamingBody():
+    def __init__(self, content):
+        self.content = content
+        self.position = 0
+
+    def read(self, amt=None):
+        if amt is None:
+            amt = len(self.content) - self.position
+        data = self.content[self.position:self.position + amt]
+        self.position += len(data)
+        return data
+
+    def iter_lines(self):
+        for line in self.content.splitlines():
+            yield line
+
+    def close(self):
+        pass
+
+
+class FakeSQS():
+    def __init__(self, aws):
+        self.aws = aws
+        self.queues = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.aws.call('sqs', 'send_message')
+        with self.lock:
+            self.queues[QueueUrl].append(MessageBody)
+        return {'MessageId': str(len(self.queues[QueueUrl]))}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.aws.call('sqs', 'send_message_batch')
+        with self.lock:
+            for entry in Entries:
+                self.queues[QueueUrl].append(entry['MessageBody'])
+        return {'Successful': [{'Id': x['Id']} for x in Entries], 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        self.aws.call('sqs', 'receive_message')
+        messages = []
+        with self.lock:
+            while self.queues[QueueUrl] and len(messages) < MaxNumberOfMessages:
+                body = self.queues[QueueUrl].popleft()
+                messages.append({'Body': body, 'ReceiptHandle': str(id(body))})
+        if messages:
+            return {'Messages': messages}
+        return {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.aws.call('sqs', 'delete_message')
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        self.aws.call('sqs', 'change_message_visibility')
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        self.aws.call('sqs', 'get_queue_attributes')
+        with self.lock:
+            count = len(self.queues[QueueUrl])
+        return {'Attributes': {'ApproximateNumberOfMessages': str(count),
+                               'ApproximateNumberOfMessagesNotVisible': '0'}}
+
+    def message_count(self, QueueUrl):
+        with self.lock:
+            return len(self.queues[QueueUrl])
+
+
+# the resource level DynamoDB api: boto3.resource('dynamodb').Table(name)
+class FakeDynamoDB():
+    def __init__(self, aws):
+        self.aws = aws
+        self.tables = collections.defaultdict(dict)
+        # attributes set by update_item, by table and key
+        self.updates = {}
+        self.lock = threading.Lock()
+        self.client = FakeDynamoDBClient(self)
+        self.meta = FakeMeta(self.client)
+
+    def Table(self, name):
+        return FakeTable(self, name)
+
+    def put(self, table_name, item):
+        # items are stored as json, so they can not be changed by the caller afterwards
+        key = json.dumps([item.get('run_id'), item.get('task_id'),
+                          item.get('user_id'), item.get('submit_date')])
+        with self.lock:
+            self.tables[table_name][key] = json.dumps(item, default=str)
+
+    def item_count(self, table_name):
+        with self.lock:
+            return len(self.tables[table_name])
+
+
+class FakeMeta():
+    def __init__(self, client):
+        self.client = client
+
+
+class FakeDynamoDBClient():
+    def __init__(self, dynamodb):
+        self.dynamodb = dynamodb
+
+    def batch_write_item(self, RequestItems):
+        self.dynamodb.aws.call('dynamodb', 'batch_write_item')
+        for table_name, requests in RequestItems.items():
+            for request in requests:
+                self.dynamodb.put(table_name, request['PutRequest']['Item'])
+        return {'UnprocessedItems': {}}
+
+
+class FakeTable():
+    def __init__(self, dynamodb, name):
+        self.dynamodb = dynamodb
+        self.name = name
+        self.meta = FakeMeta(dynamodb.client)
+
+    def put_item(self, Item, **kwargs):
+        self.dynamodb.aws.call('dynamodb', 'put_item')
+        self.dynamodb.put(self.name, Item)
+        return {}
+
+    # supports the updates of the app: "ADD <attribute> :value" and
+    # "set <attribute> = :value, <attribute> = :value, ...", conditions are not checked
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        self.dynamodb.aws.call('dynamodb', 'update_item')
+        action, rest = UpdateExpression.split(None, 1)
+        with self.dynamodb.lock:
+            item = self.dynamodb.updates.setdefault((self.name, json.dumps(Key, sort_keys=True)), {})
+            if action == 'ADD':
+                attribute, name = rest.split()
+                item[attribute] = item.get(attribute, 0) + ExpressionAttributeValues[name]
+            else:
+                for assignment in rest.split(','):
+                    attribute, name = [x.strip() for x in assignment.split('=')]
+                    item[attribute] = ExpressionAttributeValues[name]
+            return {'Attributes': dict(item)}
+
+    def get_item(self, **kwargs):
+        self.dynamodb.aws.call('dynamodb', 'get_item')
+        return {}
+
+    def query(self, **kwargs):
+        self.dynamodb.aws.call('dynamodb', 'query')
+        return {'Items': []}
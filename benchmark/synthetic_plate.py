@@ -0,0 +1,78 @@
+# helpers to generate synthetic InCell ".xdce" metadata files for benchmarking
+# the layout mimics what the dispatcher reads from a real plate:
+#   <ImageStack><Images><Image filename=...><Well label=...><Row/><Column/></Well>
+#       <Identifier field_index=.../><EmissionFilter name=.../>...</Image></Images></ImageStack>
+
+import string
+
+# plate layouts by number of wells: (rows, columns)
+PLATE_LAYOUTS = {
+    96: (8, 12),
+    384: (16, 24),
+    1536: (32, 48)
+}
+
+CHANNELS = ["DAPI", "FITC", "dsRed", "Cy5"]
+
+
+# row label as shown by InCell, "A".."Z", then "AA".."AF" for 1536-well plates
+def row_label(row_number):
+    letters = string.ascii_uppercase
+    if row_number <= len(letters):
+        return letters[row_number - 1]
+    return letters[(row_number - 1) // len(letters) - 1] + letters[(row_number - 1) % len(letters)]
+
+
+# the images of a synthetic plate, in acquisition order
+#   - yields: (row, column, well label, field index, channel, plane, filename)
+def iter_images(num_wells, num_fields=9, num_channels=4, num_planes=1):
+    rows, columns = PLATE_LAYOUTS[num_wells]
+    for row in range(1, rows + 1):
+        for column in range(1, columns + 1):
+            well = row_label(row) + " - " + str(column)
+            for field in range(num_fields):
+                for channel in CHANNELS[:num_channels]:
+                    for plane in range(num_planes):
+                        filename = (well + "(fld " + str(field + 1) + " wv " + channel +
+                                    " z " + str(plane + 1) + ").tif")
+                        yield row, column, well, field, channel, plane, filename
+
+
+# write a synthetic metadata file
+# args:
+#   - path: where to save the file
+#   - num_wells: 96, 384 or 1536
+#   - num_fields: number of fields per well
+#   - num_channels: number of channels per field, up to len(CHANNELS)
+#   - num_planes: number of z-planes per channel
+#   - returns: the number of images in the file
+def write_xdce(path, num_wells, num_fields=9, num_channels=4, num_planes=1):
+    image_count = 0
+
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<ImageStack version="1.0">\n')
+        f.write('  <AutoLeveling black="0" white="4095"/>\n')
+        f.write('  <Images number="' + str(num_wells * num_fields * num_channels * num_planes) + '">\n')
+        for row, column, well, field, channel, plane, filename in iter_images(
+                num_wells, num_fields, num_channels, num_planes):
+            f.write(
+                '    <Image filename="' + filename + '" version="1.0">\n'
+                '      <Well label="' + well + '">\n'
+                '        <Row number="' + str(row) + '"/>\n'
+                '        <Column number="' + str(column) + '"/>\n'
+                '      </Well>\n'
+                '      <Identifier field_index="' + str(field) + '" z_index="' + str(plane) +
+                '" time_index="0" wave_index="0"/>\n'
+                '      <EmissionFilter name="' + channel + '" wavelength="455" bandwidth="50"/>\n'
+                '      <ExcitationFilter name="' + channel + '" wavelength="350" bandwidth="50"/>\n'
+                '      <PlatePosition_um x="' + str(column * 9000) + '" y="' + str(row * 9000) +
+                '" z="1200.5" focus="0.0"/>\n'
+                '      <ExposureTime unit="ms" value="150"/>\n'
+                '      <AcquisitionTime unit="ms" value="' + str(image_count * 200) + '"/>\n'
+                '    </Image>\n')
+            image_count += 1
+        f.write('  </Images>\n')
+        f.write('</ImageStack>\n')
+
+    return image_count
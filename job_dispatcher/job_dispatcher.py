@@ -1,14 +1,44 @@
-import boto3
 import json
 import os
 import sys
 import xml.etree.ElementTree as ET
 import csv
+import io
+import itertools
+import shutil
+import threading
 import time
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append("..")  # Adds higher directory to python modules path.
+from libs import aws_clients
 from libs import s3worker
 from libs.JobQueue import JobQueue
+from libs.rate_limiter import RateLimiter
+from metadata_cache import MetadataCache, LocalDiskBackend, S3Backend
+
+# number of tasks collected before they are sent to the queue
+# each chunk goes out as concurrent send_message_batch calls of up to 10 messages
+ENQUEUE_CHUNK_SIZE = 100
+ENQUEUE_WORKERS = 4
+
+# number of file lists uploaded to S3 at the same time
+UPLOAD_WORKERS = 8
+
+# max number of items in one dynamodb batch_write_item request
+DYNAMODB_BATCH_SIZE = 25
+
+# cache of parsed metadata, see get_metadata_cache
+metadata_cache = None
+metadata_cache_lock = threading.Lock()
+
+# default rate limits of submit_runs, calls per second of all the plates together
+SQS_CALLS_PER_SECOND = 300
+DYNAMODB_CALLS_PER_SECOND = 100
+
+# output file of CellProfiler left out of the result consolidation
+FILE_TO_IGNORE = 'Experiment.csv'
 
 
 # parse and submit run request
@@ -28,65 +58,290 @@ from libs.JobQueue import JobQueue
 #     "sqs_url": queue_url,
 #     "image_data": {
 #         "s3_bucket": "hca-cloud-native",
-#         "prefix": "example_data/"
+#         "prefix": "example_data/",
+#         "metadata_file_key": "example_data/example.xdce"   (optional, see find_metadata_file)
 #     },
 #     "pipeline_file": {
 #         "s3_bucket": "hca-cloud-native",
 #         "key": "pipeline_files/test.cppipe"
 #     },
-#     "run_record_location": run_record_location
+#     "run_record_location": run_record_location,
+#     "task_packing": {                      (optional, one well per task by default)
+#         "mode": "image_count",
+#         "size": 500
+#     }
 # }
 
-def submit_run(run_request):
+def submit_run(run_request, rate_limiters=None):
+    if rate_limiters is None:
+        rate_limiters = {}
+
     # add run record into run table
-    run_table = boto3.resource('dynamodb').Table('runs')
+    # the run starts with one remaining task, held by the dispatcher until all tasks are submitted,
+    # see add_remaining_tasks
+    run_table = aws_clients.get_resource('dynamodb').Table('runs')
+    acquire(rate_limiters, 'dynamodb')
+    run_table.put_item(Item = dict(run_request, remaining_tasks=1))
+
+    s3 = aws_clients.get_client("s3")
+    sqs = aws_clients.get_client("sqs")
+
+    the_bucket = run_request["image_data"]["s3_bucket"]
+
+    # build the template of the task
+    task_template = build_task_template(run_request)
+
+    # each run gets its own directory, runs may be submitted at the same time
+    local_dir = os.path.join("/tmp", run_request["run_id"])
     try:
-        run_table.put_item(Item = run_request)
+        # find the metadata file first
+        metadata_file, etag = find_metadata_file(s3, run_request["image_data"])
+
+        # download and parse the metadata file, unless it was parsed before
+        def download_and_parse():
+            #  download the metadata file to /tmp (will be more efficient when the file is big)
+            # /tmp is guaranteed to be available during the execution of your Lambda function
+            if not os.path.isdir(local_dir):
+                os.makedirs(local_dir)
+            local_copy = s3worker.download_file(
+                s3, the_bucket, metadata_file, local_dir)
+            return parse_metadata_file(local_copy, run_request["image_data"]["prefix"])
+
+        # the listing gives the ETag, a metadata file named by the request needs a lookup
+        if etag is None:
+            etag = s3.head_object(Bucket=the_bucket, Key=metadata_file)['ETag']
+        rows = get_metadata_cache(s3).get_rows(the_bucket, metadata_file, etag,
+                                               run_request["image_data"]["prefix"], download_and_parse)
+
+        # save individual image file list by task and add to queue
+        def count_tasks(count):
+            return add_remaining_tasks(run_table, run_request, count, rate_limiters)
+        num_tasks = create_tasks(s3, task_template, rows, sqs, run_request["task_queue_url"],
+                                 task_packing=run_request.get("task_packing"),
+                                 rate_limiters=rate_limiters, count_tasks=count_tasks)
     except Exception as e:
-        print(e)
+        # the dispatcher keeps its remaining task, so the counter never reaches zero
+        # and the workers never finish the run
+        fail_run(run_table, run_request, e, rate_limiters)
+        raise e
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+    # all tasks are submitted, let go of the dispatcher's remaining task
+    # if the workers are done already, finishing the run is left to the dispatcher
+    if count_tasks(-1) == 0:
+        finish_run(run_table, task_template, num_tasks, rate_limiters)
 
+    print(str(num_tasks) + " tasks created for run: " + run_request["run_id"])
+    count_tasks_in_queue(run_request['task_queue_url'])
+    return num_tasks
 
-    s3 = boto3.client("s3")
-    sqs = boto3.client("sqs")
 
-    the_bucket = run_request["image_data"]["s3_bucket"]
-    the_prefix = run_request["image_data"]["prefix"]
-    metadata_file_extention = run_request["image_data"]['metadata_file_extention']
+# add to the remaining-task counter of a run
+# every chunk of tasks is counted before it is enqueued, and every finished task takes one off
+# (see update_run_status of the CellProfiler worker). Together with the one the run starts with,
+# taken off by the dispatcher at the end, the counter only reaches zero once all tasks are
+# submitted and finished. The task that takes it to zero finishes the run.
+# args:
+#   - run_table: the dynamodb table of the runs
+#   - run_request: the run request, holds the key of the run
+#   - count: number to add, negative to take off
+#   - rate_limiters: optional, {"dynamodb": RateLimiter}
+#   - returns: the counter after the update
+def add_remaining_tasks(run_table, run_request, count, rate_limiters=None):
+    if rate_limiters is None:
+        rate_limiters = {}
+
+    acquire(rate_limiters, 'dynamodb')
+    response = run_table.update_item(
+        Key={
+            'user_id': run_request['user_id'],
+            'submit_date': run_request['submit_date']
+        },
+        UpdateExpression="ADD remaining_tasks :count",
+        ExpressionAttributeValues={':count': count},
+        ReturnValues="UPDATED_NEW")
+    return response['Attributes']['remaining_tasks']
+
+
+# mark a run whose remaining-task counter reached zero as finished and push its result consolidation
+# the conditional write lets only one caller through, so the results are consolidated once
+# args:
+#   - run_table: the dynamodb table of the runs
+#   - task_template: the task template of the run, see build_task_template
+#   - num_tasks: number of tasks of the run, a run without tasks has nothing to consolidate
+#   - rate_limiters: optional, {"sqs": RateLimiter, "dynamodb": RateLimiter}
+def finish_run(run_table, task_template, num_tasks, rate_limiters=None):
+    if rate_limiters is None:
+        rate_limiters = {}
 
-    # find the metadata file first
-    metadata_files = s3worker.find_by_extension(
-        s3, the_bucket, the_prefix, metadata_file_extention)
+    try:
+        acquire(rate_limiters, 'dynamodb')
+        run_table.update_item(
+            Key={
+                'user_id': task_template['user_id'],
+                'submit_date': task_template['submit_date']
+            },
+            UpdateExpression="set the_status = :new_status",
+            ConditionExpression="remaining_tasks = :zero AND the_status <> :new_status",
+            ExpressionAttributeValues={':new_status': 'Finished', ':zero': 0})
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return
+        raise e
+
+    if num_tasks == 0:
+        return
+    acquire(rate_limiters, 'sqs')
+    JobQueue(task_template['result_consolidation_queue_url']).enqueueMessage({
+        'run_id': task_template['run_id'],
+        'run_record_bucket': task_template['run_record_location']['s3_bucket'],
+        'sub_task_record_prefix': task_template['sub_task_record_prefix'],
+        'final_output_prefix': task_template['final_output_prefix'],
+        'file_to_ignore': FILE_TO_IGNORE
+    })
+    print("run " + task_template['run_id'] + " finished, result consolidation task pushed to the queue")
+
+
+# mark a run whose submission failed as failed, with the error
+# args:
+#   - run_table: the dynamodb table of the runs
+#   - run_request: the run request, holds the key of the run
+#   - error: the error that stopped the submission
+#   - rate_limiters: optional, {"dynamodb": RateLimiter}
+def fail_run(run_table, run_request, error, rate_limiters=None):
+    if rate_limiters is None:
+        rate_limiters = {}
+
+    acquire(rate_limiters, 'dynamodb')
+    run_table.update_item(
+        Key={
+            'user_id': run_request['user_id'],
+            'submit_date': run_request['submit_date']
+        },
+        UpdateExpression="set the_status = :new_status, submission_error = :error",
+        ExpressionAttributeValues={':new_status': 'Failed', ':error': repr(error)})
+    print("submitting run " + run_request['run_id'] + " failed: " + repr(error))
+
+
+# submit many runs at the same time, e.g. all the plates of a screen
+# each plate is listed, parsed and split into tasks in its own thread,
+# the calls to SQS and DynamoDB of all the plates share one rate limiter per service
+# args:
+#   - run_requests: a list of run requests, see submit_run
+#   - max_workers: number of plates submitted at the same time
+#   - sqs_rate: max number of SQS calls per second, all plates together
+#   - dynamodb_rate: max number of DynamoDB calls per second, all plates together
+#   - returns: a list of summaries, one per plate, in the order of the requests:
+#              {"run_id": ..., "tasks": number of tasks created, "seconds": time taken, "error": None or the error}
+def submit_runs(run_requests, max_workers=8, sqs_rate=SQS_CALLS_PER_SECOND,
+                dynamodb_rate=DYNAMODB_CALLS_PER_SECOND):
+    rate_limiters = {
+        'sqs': RateLimiter(sqs_rate),
+        'dynamodb': RateLimiter(dynamodb_rate)
+    }
+
+    def submit_one(run_request):
+        summary = {"run_id": run_request["run_id"], "tasks": 0, "error": None}
+        start = time.time()
+        try:
+            summary["tasks"] = submit_run(run_request, rate_limiters)
+        except Exception as e:
+            summary["error"] = repr(e)
+        summary["seconds"] = time.time() - start
+        print(summary)
+        return summary
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summaries = list(executor.map(submit_one, run_requests))
+
+    print(str(sum(x["tasks"] for x in summaries)) + " tasks created for " + str(len(summaries)) +
+          " runs, " + str(len([x for x in summaries if x["error"]])) + " failed")
+    return summaries
+
+
+# take a token from the rate limiter of a service, if there is one
+def acquire(rate_limiters, service):
+    if rate_limiters.get(service) is not None:
+        rate_limiters[service].acquire()
+
+# find the key of the metadata file of a plate
+# the listing of the image directory is skipped when the request names the file, either directly
+# or through a manifest. Otherwise the listing is streamed and stops as soon as the answer is known.
+# args:
+#   - s3_client: the s3 client used to interact with S3 bucket
+#   - image_data: the "image_data" part of the run request, with the optional entries:
+#       - "metadata_file_key": the key of the metadata file, no listing at all
+#       - "metadata_manifest_key": the key of a json manifest in the image bucket,
+#                                  its "metadata_file" entry is the key of the metadata file
+#       - "metadata_discovery": "first_match" to take the first file with the extension,
+#                               by default the listing goes on to make sure there is only one
+#   - returns: the key of the metadata file, and its ETag if the listing found it, None otherwise
+def find_metadata_file(s3_client, image_data):
+    the_bucket = image_data["s3_bucket"]
+
+    if "metadata_file_key" in image_data:
+        return image_data["metadata_file_key"], None
+
+    if "metadata_manifest_key" in image_data:
+        response = s3_client.get_object(Bucket=the_bucket, Key=image_data["metadata_manifest_key"])
+        manifest = json.loads(response['Body'].read())
+        return manifest["metadata_file"], None
+
+    # a second match already proves the metadata file is ambiguous
+    if image_data.get("metadata_discovery") == "first_match":
+        max_results = 1
+    else:
+        max_results = 2
+
+    metadata_file_extention = image_data['metadata_file_extention']
+    metadata_files = s3worker.find_objects_by_extension(
+        s3_client, the_bucket, image_data["prefix"], metadata_file_extention, max_results)
     try:
         assert len(metadata_files) == 1
     except AssertionError as e:
         e.args += ("Found " + str(len(metadata_files)) +
-                   " metadata file(s) with extension: ", "xdce")
+                   " metadata file(s) with extension: ", metadata_file_extention)
         raise e
 
-    metadata_file = metadata_files[0]
-    #  download the metadata file to /tmp (will be more efficient when the file is big)
-    # /tmp is guaranteed to be available during the execution of your Lambda function
-    local_copy = s3worker.download_file(
-        s3, the_bucket, metadata_file, "/tmp")
-
-    rows = parse_metadata_file(local_copy, run_request["image_data"]["prefix"])
+    return metadata_files[0]['Key'], metadata_files[0]['ETag']
 
-    # build the template of the task
-    task_template = build_task_template(run_request)
 
-    # save individual image file list by well and add to queue
-    create_tasks(s3, task_template, rows, sqs, run_request["task_queue_url"])
+# get the cache of parsed metadata, created on first use and kept while the Lambda container is warm
+# configured by environment variables:
+#   - METADATA_CACHE_BUCKET, METADATA_CACHE_PREFIX: keep the cache in S3, shared by all dispatchers
+#   - METADATA_CACHE_DIR: otherwise keep the cache on local disk, "/tmp/metadata_cache" by default
+#   - METADATA_CACHE_MAX_MB: size budget of the cache
+def get_metadata_cache(s3_client):
+    global metadata_cache
+    with metadata_cache_lock:
+        if metadata_cache is not None:
+            return metadata_cache
 
-    count_tasks_in_queue(run_request['task_queue_url'])
-
-# parse the metadata and return a list of dictionaries ready to save as file list csv
+        if 'METADATA_CACHE_BUCKET' in os.environ:
+            backend = S3Backend(s3_client, os.environ['METADATA_CACHE_BUCKET'],
+                                os.environ.get('METADATA_CACHE_PREFIX', 'metadata_cache/'))
+        else:
+            backend = LocalDiskBackend(os.environ.get('METADATA_CACHE_DIR', '/tmp/metadata_cache'))
+        max_bytes = int(os.environ.get('METADATA_CACHE_MAX_MB', '256')) * 1024 * 1024
+        metadata_cache = MetadataCache(backend, max_bytes)
+        return metadata_cache
+
+
+# parse the metadata and yield the image groups ready to save as file list csv
+# the file is parsed incrementally, each "Image" element is dropped once it is read,
+# so memory is taken by the groups only, not by the element tree.
+# images of a well may come in any order (channel-major or time-lapse acquisitions interleave
+# the wells), the groups are yielded at the end, well by well in the order the wells first appear.
+# A well is only complete at the end of the file, so every group is held until then: memory
+# grows with the number of groups (wells x fields, about 1.5 KB each), not with the number of images
 # args:
 #   - metadata_file: the path to the local copy of the metadat file
 #   - image_prefix: the prefix to the images in S3 bucket.
 #                   The prefix will be added to the image path
 #                   The worker will mount S3 bucket as local storage and access images through the prefix
 #                   The bucket info exists in the task message, not here.
-#   - returns: a list of dictionaries ready to save as csv
+#   - yields: dictionaries ready to save as csv, one per well/field group
 def parse_metadata_file(metadata_file, image_prefix):
     # the location where the images will appear in CP worker
     # need to define here since CP requires the full path to the image in the file list.
@@ -98,39 +353,55 @@ def parse_metadata_file(metadata_file, image_prefix):
     else:
         valid_image_prefix = image_prefix
 
-    tree = ET.parse(metadata_file)
-    root = tree.getroot()
+    url_prefix = "file:" + IMAGE_DATA_BUCKET_DIR + valid_image_prefix
+
+    # groups by well, then by group id
     groups = {}
+    # the chain of open elements, used to detach each image from its parent once read
+    open_elements = []
+
+    for event, element in ET.iterparse(metadata_file, events=("start", "end")):
+        if event == "start":
+            open_elements.append(element)
+            continue
+
+        open_elements.pop()
+        if element.tag != "Image":
+            continue
 
-    # extract the information we are interested in
-    for image in root.iter("Image"):
-        filename = image.attrib["filename"]
-        the_well = image.find("Well")
+        # extract the information we are interested in
+        filename = element.attrib["filename"]
+        the_well = element.find("Well")
         well = the_well.get("label")
         row = the_well.find("Row").get("number")
         column = the_well.find("Column").get("number")
-        field = image.find("Identifier").get("field_index")
-        color = image.find("EmissionFilter").get("name")
+        field = element.find("Identifier").get("field_index")
+        color = element.find("EmissionFilter").get("name")
         URL_title = "URL_" + color
         group_id = well + "@" + field
 
+        # drop the image from the tree, we have what we need
+        element.clear()
+        if open_elements:
+            open_elements[-1].remove(element)
+
         # update the group list
-        if not group_id in groups:
-            groups[group_id] = {
+        well_groups = groups.setdefault(well, {})
+        if not group_id in well_groups:
+            well_groups[group_id] = {
                 "Row_Number": row,
                 "Column_Number": column,
                 "Well_Location": well,
                 "Field_Index": field,
-                URL_title: "file:" + IMAGE_DATA_BUCKET_DIR + valid_image_prefix + filename
+                URL_title: url_prefix + filename
             }
         else:
-            groups[group_id][URL_title] = "file:" + \
-                IMAGE_DATA_BUCKET_DIR + valid_image_prefix + filename
+            well_groups[group_id][URL_title] = url_prefix + filename
 
-    rows = []
-    for key, val in groups.items():
-        rows.append(val)
-    return rows
+    # the rows of a well stay together, tasks are packed by well
+    for well_groups in groups.values():
+        for val in well_groups.values():
+            yield val
 
 
 # build task template based on run request
@@ -170,80 +441,250 @@ def build_task_template(run_request):
     # }
 
 
-# write rows to csv file, submit to S3 and sqs, each file contains groups from the same well
+# write rows to csv file, submit to S3 and sqs, each file contains the groups of one task
 # args:
 #   -s3_client: the s3 client used to interact with S3 bucket
 #   -the_bucket: the S3 bucket to save the file list
 #   -task_template: the message template to enqueue to sqs
-#   - rows: a list of dict, each dict is one row of the image list,
+#   - rows: an iterable of dict, each dict is one row of the image list,
 #         contains images from the same well, same field
 #   - each task will have individual directory for the image list and output
 #   - a post-processing lambda will combine the output to sigle result file later
+#   - upload_workers: number of file lists uploaded at the same time
+#   - task_packing: how image groups are packed into tasks, see pack_tasks. One well per task by default
+#   - rate_limiters: optional, {"sqs": RateLimiter, "dynamodb": RateLimiter} shared with other runs
+#   - count_tasks: optional, called with the number of tasks about to be enqueued, see add_remaining_tasks
+#   - returns: number of tasks written to the task table
 
 def create_tasks(s3_client, task_template, rows,
-                 sqs_client, QueueUrl):
-    current_well = ""
-    rows_for_task = []
+                 sqs_client, QueueUrl, upload_workers=UPLOAD_WORKERS, task_packing=None,
+                 rate_limiters=None, count_tasks=None):
+    pending_tasks = []
+    rows_written = 0
 
     task_queue = JobQueue(QueueUrl)
+    task_table = aws_clients.get_resource('dynamodb').Table(task_template['task_table'])
+
+    with ThreadPoolExecutor(max_workers=upload_workers) as uploader:
+        for task_id, rows_for_task in pack_tasks(rows, task_packing):
+            the_task = build_task(task_template, task_id)
+
+            # render the file list in memory and upload it in the background
+            upload = uploader.submit(
+                s3worker.upload_content, s3_client, render_csv(rows_for_task),
+                task_template["run_record_location"]["s3_bucket"], the_task["file_list_key"])
+
+            # register and enqueue the tasks in chunks, so workers can start before all wells are done
+            pending_tasks.append((the_task, upload))
+            if len(pending_tasks) >= ENQUEUE_CHUNK_SIZE:
+                rows_written += submit_tasks(task_table, task_queue, pending_tasks, rate_limiters,
+                                             count_tasks)
+                pending_tasks = []
+
+        if pending_tasks:
+            rows_written += submit_tasks(task_table, task_queue, pending_tasks, rate_limiters,
+                                         count_tasks)
+
+    print(str(rows_written) + " tasks written to table: " + task_template['task_table'])
+    return rows_written
+
+
+# fill in the task specific pieces of the task template
+def build_task(task_template, task_id):
+    the_task = task_template.copy()
+    the_task["task_id"] = task_id
+    the_task["task_input_prefix"] = the_task["sub_task_record_prefix"] + \
+        task_id + "/input/"
+    the_task["task_output_prefix"] = the_task["sub_task_record_prefix"] + \
+        task_id + "/output/"
+    the_task["file_list_key"] = the_task["task_input_prefix"] + \
+        task_id + ".csv"
+    return the_task
+
+
+# split the image groups into tasks
+# args:
+#   - rows: an iterable of dict from parse_metadata_file, one per well/field, ordered by well
+#   - task_packing: a dict describes how to pack the groups, None to use one well per task
+#         {"mode": "per_well"}                      one well per task
+#         {"mode": "per_field"}                     one field per task
+#         {"mode": "n_wells", "size": 4}            N wells per task
+#         {"mode": "image_count", "size": 500}      about "size" images per task, wells may be split by field
+#   - yields: (task_id, rows of the task)
+def pack_tasks(rows, task_packing=None):
+    if task_packing is None:
+        task_packing = {"mode": "per_well"}
+
+    try:
+        packer = TASK_PACKERS[task_packing["mode"]]
+    except KeyError as e:
+        e.args += ("Unknown task packing mode, choose from: ", list(TASK_PACKERS.keys()))
+        raise e
+
+    size = task_packing.get("size")
+    if packer in (pack_n_wells, pack_by_image_count) and not (size and size > 0):
+        raise ValueError("Task packing mode " + task_packing["mode"] + " needs a positive size")
+
+    return packer(rows, size)
+
+
+def pack_per_field(rows, size=None):
+    for row in rows:
+        yield row["Well_Location"] + "@" + row["Field_Index"], [row]
+
 
-    # add a dummy row to flush the last well
-    rows.append({"Well_Location": "dummy"})
+def pack_per_well(rows, size=None):
+    for well, well_rows in itertools.groupby(rows, lambda row: row["Well_Location"]):
+        yield well, list(well_rows)
+
+
+def pack_n_wells(rows, size):
+    wells = []
+    rows_for_task = []
+    for well, well_rows in pack_per_well(rows):
+        wells.append(well)
+        rows_for_task.extend(well_rows)
+        if len(wells) == size:
+            yield task_id_of_range(wells[0], wells[-1]), rows_for_task
+            wells = []
+            rows_for_task = []
+
+    if wells:
+        yield task_id_of_range(wells[0], wells[-1]), rows_for_task
+
+
+# fill each task with fields until it holds "size" images,
+# so every task costs roughly the same no matter how sparse or dense the wells are
+def pack_by_image_count(rows, size):
+    rows_for_task = []
+    image_count = 0
     for row in rows:
-        if row["Well_Location"] != current_well:
-            # one well is done. save to local file under "/tmp" and upload to S3
-            if current_well != "":
-                the_task = task_template.copy()
-                the_task["task_id"] = current_well
-                the_task["task_input_prefix"] = the_task["sub_task_record_prefix"] + \
-                    current_well + "/input/"
-                the_task["task_output_prefix"] = the_task["sub_task_record_prefix"] + \
-                    current_well + "/output/"
-                the_task["file_list_key"] = the_task["task_input_prefix"] + \
-                    current_well + ".csv"
-
-                local_file = "/tmp/" + \
-                    task_template["run_id"] + "-" + current_well + ".csv"
-
-                save_to_csv(rows_for_task, local_file)
-                s3worker.upload_file(s3_client, local_file,
-                                     task_template["run_record_location"]["s3_bucket"], the_task["file_list_key"])
-                os.remove(local_file)
-                rows_for_task = []
-
-                # add task into task table
-                task_table = boto3.resource('dynamodb').Table(task_template['task_table'])
-                try:
-                    task_table.put_item(Item = the_task)
-                except Exception as e:
-                    print(e)
-
-                # enqueue the task
-                task_queue.enqueueMessage(the_task)
-                # message = json.dumps(the_task)
-                # enqueue_task(sqs_client, message)
-
-            current_well = row["Well_Location"]
         rows_for_task.append(row)
+        image_count += count_images(row)
+        if image_count >= size:
+            yield task_id_of_rows(rows_for_task), rows_for_task
+            rows_for_task = []
+            image_count = 0
+
+    if rows_for_task:
+        yield task_id_of_rows(rows_for_task), rows_for_task
+
+
+# number of images referenced by one row of the file list
+def count_images(row):
+    return len([x for x in row.keys() if x.startswith("URL_")])
 
 
-# helper function to save dict to csv file
+def task_id_of_range(first, last):
+    if first == last:
+        return first
+    return first + " to " + last
+
+
+def task_id_of_rows(rows_for_task):
+    first = rows_for_task[0]
+    last = rows_for_task[-1]
+    return task_id_of_range(first["Well_Location"] + "@" + first["Field_Index"],
+                            last["Well_Location"] + "@" + last["Field_Index"])
+
+
+TASK_PACKERS = {
+    "per_field": pack_per_field,
+    "per_well": pack_per_well,
+    "n_wells": pack_n_wells,
+    "image_count": pack_by_image_count
+}
+
+
+# add tasks into task table, then enqueue them
+# a task is only registered once its file list is uploaded,
+# and registered before it is enqueued so workers always find the record they update
+# args:
+#   - task_table: the dynamodb table to save the tasks
+#   - task_queue: the JobQueue to send the tasks to
+#   - pending_tasks: a list of (task message, file list upload future)
+#   - rate_limiters: optional, {"sqs": RateLimiter, "dynamodb": RateLimiter}
+#   - count_tasks: optional, called with the number of tasks before they are enqueued,
+#     and with minus the number of them that were not enqueued if enqueueing failed
+#   - returns: number of rows written to the task table
+def submit_tasks(task_table, task_queue, pending_tasks, rate_limiters=None, count_tasks=None):
+    if rate_limiters is None:
+        rate_limiters = {}
+
+    tasks = []
+    for the_task, upload in pending_tasks:
+        # raises if the upload failed
+        upload.result()
+        tasks.append(the_task)
+
+    rows_written = batch_put_items(task_table, tasks, rate_limiter=rate_limiters.get('dynamodb'))
+    # counted before a worker can finish them
+    if count_tasks is not None:
+        count_tasks(len(tasks))
+    try:
+        task_queue.enqueueMessages(tasks, max_workers=ENQUEUE_WORKERS,
+                                   rate_limiter=rate_limiters.get('sqs'))
+    except Exception as e:
+        # the tasks that did not make it to the queue will never be finished
+        if count_tasks is not None:
+            count_tasks(-(len(tasks) - getattr(e, 'sent', 0)))
+        raise e
+    return rows_written
+
+
+# write items to a dynamodb table with batch_write_item, 25 items per request
+# unprocessed items are retried with exponential backoff
+# args:
+#   - table: the dynamodb table resource
+#   - items: a list of items to put
+#   - max_retries: number of retries for unprocessed items before giving up
+#   - rate_limiter: optional, shared limiter taken before each request
+#   - returns: number of items written
+def batch_put_items(table, items, max_retries=8, rate_limiter=None):
+    client = table.meta.client
+    rows_written = 0
+
+    for i in range(0, len(items), DYNAMODB_BATCH_SIZE):
+        requests = [{'PutRequest': {'Item': item}} for item in items[i:i + DYNAMODB_BATCH_SIZE]]
+
+        for attempt in range(max_retries + 1):
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            response = client.batch_write_item(RequestItems={table.name: requests})
+            unprocessed = response.get('UnprocessedItems', {}).get(table.name, [])
+            rows_written += len(requests) - len(unprocessed)
+            if not unprocessed:
+                break
+            requests = unprocessed
+            time.sleep(0.05 * 2 ** attempt)
+        else:
+            raise RuntimeError(str(len(requests)) + " items not written to table " +
+                               table.name + " after " + str(max_retries) + " retries")
+
+    return rows_written
+
+
+# helper function to render dict rows as csv file content
 #   args:
-#       - output_path: specify the path to save the file
-#       - filename: the csv file name
 #       - rows: the rows to be written to the file
+#       - returns: the content of the csv file in bytes
+
+def render_csv(rows):
+    # rows of a task can come from wells imaged with different channels
+    header = []
+    for row in rows:
+        header.extend(x for x in row.keys() if x not in header)
 
-def save_to_csv(rows, filename):
-    print("writing data to: " + filename)
-    with open(filename, "w") as f:
-        w = csv.DictWriter(f, rows[0].keys())
-        w.writeheader()
-        w.writerows(rows)
+    buffer = io.StringIO()
+    w = csv.DictWriter(buffer, header)
+    w.writeheader()
+    w.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
 
 
 # check number of messages in the queue
 def count_tasks_in_queue(queue_url):
-    client = boto3.client("sqs")
+    client = aws_clients.get_client("sqs")
     print("getting number of messages in the queue")
     # get queue attributes
     response = client.get_queue_attributes(
@@ -304,4 +745,5 @@ run_request = {
 # the location to store the analysis result
 # sub-dir structure will be created to save result from each taks
 
-submit_run(run_request)
+if __name__ == '__main__':
+    submit_run(run_request)
@@ -0,0 +1,180 @@
+# a cache of parsed plate metadata, so a plate submitted again with a new pipeline
+# skips downloading and parsing its metadata file.
+# entries are keyed by the bucket, key and ETag of the metadata file (plus the image prefix,
+# which is part of every image url), so a changed metadata file is never served from the cache.
+# entries are gzipped json lines, one image group per line, written and read as a stream.
+# the cache is shared by the threads of submit_runs.
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from botocore.exceptions import ClientError
+
+# bump when the layout of the parsed rows changes, old entries will be ignored
+CACHE_FORMAT_VERSION = "1"
+
+
+class MetadataCache():
+    # args:
+    #   - backend: where the entries are stored, LocalDiskBackend or S3Backend
+    #   - max_bytes: size budget of the cache, oldest entries are evicted beyond it
+    def __init__(self, backend, max_bytes):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # get the parsed rows of a metadata file
+    # args:
+    #   - the_bucket, the_key, etag: identify the metadata file and its version
+    #   - image_prefix: the prefix passed to the parser
+    #   - parse: a function without argument, downloads and parses the file on a miss
+    #   - returns: an iterable of rows, same as the parser
+    def get_rows(self, the_bucket, the_key, etag, image_prefix, parse):
+        entry_name = self.entry_name(the_bucket, the_key, etag, image_prefix)
+        data = self.backend.get(entry_name)
+        if data is not None:
+            with self.lock:
+                self.hits += 1
+            print("metadata cache hit: " + the_key + " " + str(self.stats()))
+            return self.read_entry(data)
+
+        with self.lock:
+            self.misses += 1
+        print("metadata cache miss: " + the_key + " " + str(self.stats()))
+        return self.write_entry(entry_name, parse())
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0
+            }
+
+    def entry_name(self, the_bucket, the_key, etag, image_prefix):
+        identity = "\n".join([CACHE_FORMAT_VERSION, the_bucket, the_key, etag, image_prefix])
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest() + ".jsonl.gz"
+
+    # data: the entry opened by the backend
+    def read_entry(self, data):
+        try:
+            with gzip.open(data, 'rt') as f:
+                for line in f:
+                    yield json.loads(line)
+        finally:
+            self.backend.release(data)
+
+    # pass the rows through while saving them,
+    # the entry is only stored once all the rows have been read
+    def write_entry(self, entry_name, rows):
+        fd, spool_file = tempfile.mkstemp(suffix=".jsonl.gz")
+        os.close(fd)
+        try:
+            with gzip.open(spool_file, 'wt') as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+                    yield row
+            self.backend.put(entry_name, spool_file)
+            self.backend.evict(self.max_bytes)
+        finally:
+            if os.path.exists(spool_file):
+                os.remove(spool_file)
+
+
+# keep the entries in a local directory, /tmp survives between warm Lambda invocations
+# entries are evicted least recently used first. An entry is opened when it is looked up,
+# so it can still be read if it is evicted in the meantime
+class LocalDiskBackend():
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    # returns the entry open for reading, None if not cached
+    def get(self, entry_name):
+        path = os.path.join(self.cache_dir, entry_name)
+        with self.lock:
+            try:
+                data = open(path, 'rb')
+            except (IOError, OSError):
+                return None
+            # mark as recently used
+            os.utime(path, None)
+        return data
+
+    def release(self, data):
+        data.close()
+
+    def put(self, entry_name, spool_file):
+        shutil.move(spool_file, os.path.join(self.cache_dir, entry_name))
+
+    def evict(self, max_bytes):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total_bytes = sum(x[1] for x in entries)
+            for mtime, size, name in sorted(entries):
+                if total_bytes <= max_bytes:
+                    break
+                os.remove(os.path.join(self.cache_dir, name))
+                total_bytes -= size
+
+
+# keep the entries under a prefix in a S3 bucket, shared by all dispatchers
+# entries are evicted oldest written first
+class S3Backend():
+    def __init__(self, s3_client, the_bucket, the_prefix):
+        self.s3_client = s3_client
+        self.the_bucket = the_bucket
+        if the_prefix[-1:] != '/':
+            self.the_prefix = the_prefix + '/'
+        else:
+            self.the_prefix = the_prefix
+
+    # download the entry to a local spool file, returns it open for reading, None if not cached
+    def get(self, entry_name):
+        fd, local_copy = tempfile.mkstemp(suffix=".jsonl.gz")
+        data = os.fdopen(fd, 'w+b')
+        try:
+            self.s3_client.download_fileobj(self.the_bucket, self.the_prefix + entry_name, data)
+        except ClientError as e:
+            data.close()
+            os.remove(local_copy)
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise e
+        data.seek(0)
+        return data
+
+    def release(self, data):
+        data.close()
+        os.remove(data.name)
+
+    def put(self, entry_name, spool_file):
+        self.s3_client.upload_file(spool_file, self.the_bucket, self.the_prefix + entry_name)
+
+    def evict(self, max_bytes):
+        entries = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.the_bucket, Prefix=self.the_prefix):
+            for item in page.get('Contents', []):
+                entries.append((item['LastModified'], item['Size'], item['Key']))
+
+        total_bytes = sum(x[1] for x in entries)
+        for last_modified, size, key in sorted(entries):
+            if total_bytes <= max_bytes:
+                break
+            self.s3_client.delete_object(Bucket=self.the_bucket, Key=key)
+            total_bytes -= size
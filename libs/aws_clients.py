@@ -0,0 +1,65 @@
+# one AWS client per service and process, shared by the modules of the app
+# creating a client loads its service model and opens a new connection pool, which costs
+# CPU time, and the first call of every new pool pays for a TLS handshake.
+# clients are thread safe and shared by all threads. Resources are not, every thread gets its own.
+#
+# the clients are configured from the environment:
+#   - AWS_MAX_POOL_CONNECTIONS: connections kept open per client, enough for the threads sharing it
+#   - AWS_MAX_ATTEMPTS: number of retries of a throttled or failed call
+#   - AWS_TCP_KEEPALIVE: send TCP keep-alive on idle connections, left out with a botocore too old for it
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50'))
+MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+TCP_KEEPALIVE = os.environ.get('AWS_TCP_KEEPALIVE', 'true').lower() == 'true'
+
+clients = {}
+resources = threading.local()
+# the default boto3 session is not safe to use from several threads at once
+lock = threading.Lock()
+
+
+def build_config():
+    options = {
+        'max_pool_connections': MAX_POOL_CONNECTIONS,
+        'retries': {'max_attempts': MAX_ATTEMPTS}
+    }
+    if TCP_KEEPALIVE:
+        options['tcp_keepalive'] = True
+    try:
+        return Config(**options)
+    except TypeError:
+        # botocore without tcp_keepalive
+        options.pop('tcp_keepalive')
+        return Config(**options)
+
+
+# get the shared client of a service, e.g. "s3", created on first use
+def get_client(service_name):
+    with lock:
+        if service_name not in clients:
+            clients[service_name] = boto3.client(service_name, config=build_config())
+        return clients[service_name]
+
+
+# get the resource of a service, e.g. "dynamodb", for the calling thread
+def get_resource(service_name):
+    if not hasattr(resources, 'by_service'):
+        resources.by_service = {}
+    if service_name not in resources.by_service:
+        with lock:
+            resources.by_service[service_name] = boto3.resource(service_name, config=build_config())
+    return resources.by_service[service_name]
+
+
+# forget the clients, the next calls create new ones
+# resources of other threads are only dropped when those threads end
+def reset():
+    global resources
+    with lock:
+        clients.clear()
+        resources = threading.local()
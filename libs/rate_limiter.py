@@ -0,0 +1,31 @@
+# a token bucket to keep calls to an AWS service under a rate
+# shared by threads, each call takes a token and waits when the bucket is empty
+
+import threading
+import time
+
+
+class RateLimiter():
+    # args:
+    #   - rate: number of calls per second
+    #   - burst: number of calls allowed at once after an idle period, one second worth by default
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    # wait until the call can go
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
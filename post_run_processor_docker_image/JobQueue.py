@@ -1,16 +1,32 @@
 # a class to handle job queue operation
 
 import json
-import boto3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from libs import aws_clients
+except ImportError:
+    # the docker images have the libs next to the app
+    import aws_clients
 
 class JobQueue():
+    # limits of send_message_batch
+    MAX_BATCH_SIZE = 10
+    MAX_BATCH_BYTES = 262144
+    # a message can not stay invisible longer than this after it was received
+    MAX_VISIBILITY_SECONDS = 43200
+
     def __init__(self, queueURL):
-        self.client = boto3.client('sqs')
+        self.client = aws_clients.get_client('sqs')
         self.queueURL = queueURL
+        self.heartbeat = None
 
-    def readMessage(self):
+    # wait_seconds: how long to wait for a message, 0 returns right away
+    def readMessage(self, wait_seconds=20):
         response = self.client.receive_message(QueueUrl=self.queueURL,
-                                               WaitTimeSeconds=20)
+                                               WaitTimeSeconds=wait_seconds)
         if 'Messages' in response.keys():
             data = json.loads(response['Messages'][0]['Body'])
             handle = response['Messages'][0]['ReceiptHandle']
@@ -19,15 +35,55 @@ class JobQueue():
             return None, None
 
     def deleteMessage(self, handle):
+        if self.heartbeat is not None:
+            self.heartbeat.untrack(handle, True)
         self.client.delete_message(QueueUrl=self.queueURL,
                                    ReceiptHandle=handle)
         return
 
     def returnMessage(self, handle):
+        if self.heartbeat is not None:
+            self.heartbeat.untrack(handle, False)
         self.client.change_message_visibility(QueueUrl=self.queueURL,
                                               ReceiptHandle=handle,
                                               VisibilityTimeout=60)
         return
+
+    # keep a received message invisible for another visibility_timeout seconds from now
+    def extendMessage(self, handle, visibility_timeout):
+        self.client.change_message_visibility(QueueUrl=self.queueURL,
+                                              ReceiptHandle=handle,
+                                              VisibilityTimeout=int(visibility_timeout))
+        return
+
+    # start extending the visibility of tracked messages in the background
+    # args:
+    #   - interval: seconds between two checks of the tracked messages
+    def startHeartbeat(self, interval=30):
+        if self.heartbeat is None:
+            self.heartbeat = VisibilityHeartbeat(self, interval)
+            self.heartbeat.start()
+        return self.heartbeat
+
+    def stopHeartbeat(self):
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat = None
+
+    # keep a message invisible until it is deleted or returned, does nothing without a heartbeat
+    # args:
+    #   - handle: receipt handle of the message
+    #   - received_at: when the message was received
+    #   - visible_at: when the message shows up in the queue again unless extended
+    def trackMessage(self, handle, received_at, visible_at):
+        if self.heartbeat is not None:
+            self.heartbeat.track(handle, received_at, visible_at)
+
+    # the default visibility timeout of the queue, in seconds
+    def getVisibilityTimeout(self):
+        response = self.client.get_queue_attributes(QueueUrl=self.queueURL,
+                                                    AttributeNames=['VisibilityTimeout'])
+        return int(response['Attributes']['VisibilityTimeout'])
     
     def enqueueMessage(self, the_message_in_json):
         message = json.dumps(the_message_in_json)
@@ -38,3 +94,159 @@ class JobQueue():
         )
 
         print("message sent")
+
+    # send many messages with send_message_batch
+    # messages are packed up to 10 per batch and under the batch size limit,
+    # batches are sent concurrently and only the failed entries are retried
+    # args:
+    #   - messages_in_json: a list of messages to send
+    #   - max_workers: number of batches in flight at the same time
+    #   - max_retries: number of retries for failed entries before giving up
+    #   - rate_limiter: optional, shared limiter taken before each call to the queue
+    #   - returns: number of messages sent
+    # if a batch fails, the other batches are still sent, then the first error is raised
+    # with the number of messages sent in its "sent" attribute
+    def enqueueMessages(self, messages_in_json, max_workers=4, max_retries=5, rate_limiter=None):
+        batches = self.packBatches([json.dumps(m) for m in messages_in_json])
+
+        def send(batch):
+            try:
+                return self.sendBatch(batch, max_retries, rate_limiter), None
+            except Exception as e:
+                return getattr(e, 'sent', 0), e
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(send, batches))
+        sent = sum(x[0] for x in results)
+        errors = [x[1] for x in results if x[1] is not None]
+
+        print(str(sent) + " messages sent in " + str(len(batches)) + " batches")
+        if errors:
+            print(str(len(errors)) + " batches failed")
+            errors[0].sent = sent
+            raise errors[0]
+        return sent
+
+    # split message bodies into batches accepted by send_message_batch
+    def packBatches(self, bodies):
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for body in bodies:
+            body_bytes = len(body.encode('utf-8'))
+            if batch and (len(batch) == self.MAX_BATCH_SIZE or
+                          batch_bytes + body_bytes > self.MAX_BATCH_BYTES):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(body)
+            batch_bytes += body_bytes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    # send one batch, retry the failed entries with exponential backoff
+    # returns number of messages sent
+    # an error carries the number of messages of the batch sent before it in its "sent" attribute
+    def sendBatch(self, bodies, max_retries, rate_limiter=None):
+        entries = [{'Id': str(i), 'MessageBody': body} for i, body in enumerate(bodies)]
+
+        try:
+            for attempt in range(max_retries + 1):
+                if rate_limiter is not None:
+                    rate_limiter.acquire()
+                response = self.client.send_message_batch(QueueUrl=self.queueURL,
+                                                          Entries=entries)
+                failed = response.get('Failed', [])
+                failed_ids = set(x['Id'] for x in failed)
+                entries = [x for x in entries if x['Id'] in failed_ids]
+                if not failed:
+                    return len(bodies)
+
+                # sender faults are bad requests, retrying won't help
+                sender_faults = [x for x in failed if x.get('SenderFault')]
+                if sender_faults:
+                    raise ValueError("Messages rejected by the queue: " + str(sender_faults))
+
+                time.sleep(0.1 * 2 ** attempt)
+
+            raise RuntimeError(str(len(entries)) + " messages failed after " + str(max_retries) +
+                               " retries: " + str(failed))
+        except Exception as e:
+            e.sent = len(bodies) - len(entries)
+            raise e
+
+
+# extends the visibility of the messages being worked on, so a long task does not
+# show up in the queue again and get processed twice.
+# a message is extended when it gets within three intervals of showing up again. how far is
+# based on the durations of the finished messages: to 1.5 times the expected remaining time of
+# the longest recent one, at least four intervals. so short tasks are rarely extended and
+# long ones in a few large steps.
+class VisibilityHeartbeat(threading.Thread):
+    def __init__(self, job_queue, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.job_queue = job_queue
+        self.interval = interval
+        # handle: [received_at, tracked_at, visible_at]
+        self.handles = {}
+        # seconds from tracking to deleting of recent messages
+        self.durations = deque(maxlen=100)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.metrics = {'extensions': 0, 'failed_extensions': 0}
+
+    def track(self, handle, received_at, visible_at):
+        with self.lock:
+            self.handles[handle] = [received_at, time.time(), visible_at]
+
+    # stop extending a message, finished messages add to the observed durations
+    def untrack(self, handle, finished):
+        with self.lock:
+            entry = self.handles.pop(handle, None)
+            if entry is not None and finished:
+                self.durations.append(time.time() - entry[1])
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.beat()
+
+    # extend the messages that are about to show up again
+    def beat(self):
+        now = time.time()
+        with self.lock:
+            due = [(handle, entry[0], entry[1]) for handle, entry in self.handles.items()
+                   if entry[2] - now < 3 * self.interval]
+
+        for handle, received_at, tracked_at in due:
+            visibility_timeout = self.nextTimeout(now - tracked_at, now - received_at)
+            if visibility_timeout <= 0:
+                continue
+            try:
+                self.job_queue.extendMessage(handle, visibility_timeout)
+            except Exception as e:
+                # the message may have been deleted meanwhile, its handle is no longer valid
+                with self.lock:
+                    if handle in self.handles:
+                        self.metrics['failed_extensions'] += 1
+                        print("failed to extend message visibility: " + repr(e))
+                continue
+
+            with self.lock:
+                if handle in self.handles:
+                    self.handles[handle][2] = now + visibility_timeout
+                    self.metrics['extensions'] += 1
+
+    # seconds to keep a message invisible from now
+    # args:
+    #   - elapsed: seconds since the message was tracked
+    #   - age: seconds since the message was received
+    def nextTimeout(self, elapsed, age):
+        with self.lock:
+            expected = max(self.durations) if self.durations else 0
+        visibility_timeout = max(1.5 * (expected - elapsed), 4 * self.interval)
+        return int(min(visibility_timeout, JobQueue.MAX_VISIBILITY_SECONDS - age))
@@ -1,10 +1,21 @@
 # the post run processor is used to consolidate run result from each individual tasks
 # and put the result into the final output dir of each job
+import io
+import json
 import os
+import shutil
+import struct
 import sys
-import boto3
+import tempfile
 import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # only needed for the parquet output
+    pa = None
 
+import aws_clients
 import s3worker
 from JobQueue import JobQueue
 
@@ -15,6 +26,39 @@ from JobQueue import JobQueue
 app_config = {}
 app_config['job_queue'] = os.environ['RESULT_CONSOLIDATION_QUEUE_URL']
 app_config['run_log_file_keyword'] = 'Experiment.csv'
+# number of task directories listed at the same time, 0 to list the run in one sequence
+app_config['listing_workers'] = int(os.environ.get('LISTING_WORKERS', '0'))
+# how the result files are consolidated:
+#   - pandas: every file of a group is loaded and concatenated in memory, columns may differ
+#   - stream: the files are copied in chunks into a multipart upload, their headers must match.
+#             memory use is set by the chunk and part sizes, not by the size of the run
+app_config['consolidation_mode'] = os.environ.get('CONSOLIDATION_MODE', 'pandas')
+if app_config['consolidation_mode'] not in ('pandas', 'stream'):
+    raise ValueError("Unknown CONSOLIDATION_MODE: " + app_config['consolidation_mode'])
+app_config['read_chunk_mb'] = int(os.environ.get('CONSOLIDATION_READ_CHUNK_MB', '1'))
+app_config['upload_part_mb'] = int(os.environ.get('CONSOLIDATION_PART_MB', '16'))
+# number of result files downloaded at the same time, while the downloaded ones are consolidated
+app_config['download_workers'] = int(os.environ.get('DOWNLOAD_WORKERS', '8'))
+# directory the result files are downloaded to, so the files downloaded ahead do not add to the
+# memory use. "memory" keeps them in memory instead, which takes up to download_workers * 2 whole files
+app_config['download_spool_dir'] = os.environ.get('DOWNLOAD_SPOOL_DIR', tempfile.gettempdir())
+if app_config['download_spool_dir'] == 'memory':
+    app_config['download_spool_dir'] = None
+# formats of the consolidated files, comma separated: csv, parquet. Each format is a pass over the results
+app_config['output_formats'] = os.environ.get('CONSOLIDATED_FORMATS', 'csv').split(',')
+for output_format in app_config['output_formats']:
+    if output_format not in ('csv', 'parquet'):
+        raise ValueError("Unknown format in CONSOLIDATED_FORMATS: " + output_format)
+if 'parquet' in app_config['output_formats'] and pa is None:
+    raise ImportError("The parquet output needs pyarrow")
+app_config['parquet_compression'] = os.environ.get('PARQUET_COMPRESSION', 'snappy')
+
+# written at the start of every consolidated file, like pandas does with utf-8-sig
+UTF8_BOM = b'\xef\xbb\xbf'
+
+# the well and the image set of a row of a result table, see split_by_well
+WELL_COLUMN = 'Metadata_Well'
+IMAGE_NUMBER_COLUMN = 'ImageNumber'
 
 
 # main work loop
@@ -30,11 +74,19 @@ def main():
         print("got one task:")
         print(message)
 
-        s3_client = boto3.client('s3')
+        s3_client = aws_clients.get_client('s3')
         result_file_groups = get_result_files(
             s3_client, message['run_record_bucket'], message['sub_task_record_prefix'], app_config['run_log_file_keyword'])
-        consolidate_and_upload(s3_client, result_file_groups,
-                               message['run_record_bucket'], message['final_output_prefix'])
+        if 'csv' in app_config['output_formats']:
+            if app_config['consolidation_mode'] == 'stream':
+                consolidate_and_upload_streaming(s3_client, result_file_groups, message['run_record_bucket'],
+                                                 message['final_output_prefix'])
+            else:
+                consolidate_and_upload(s3_client, result_file_groups,
+                                       message['run_record_bucket'], message['final_output_prefix'])
+        if 'parquet' in app_config['output_formats']:
+            consolidate_to_parquet(s3_client, result_file_groups,
+                                   message['run_record_bucket'], message['final_output_prefix'])
         task_queue.returnMessage(handle)
         break
 
@@ -46,12 +98,17 @@ def main():
 #   - the_prefix:   the prefix to the run result. Best practice is to point to "sub_tasks" dir
 #   - run_log_fname_keyword: the keyword to identify the run log. Will be excluded from result files
 def get_result_files(s3_client, the_bucket, the_prefix, run_log_fname_keyword):
-    content = s3worker.get_content_in_dir(
-        s3_client, the_bucket, the_prefix, True)['files']
+    # keys are filtered as they arrive. With listing workers, each task directory is listed
+    # in parallel, which pays off when tasks hold more than a page (1000) of files each
+    if app_config['listing_workers'] > 0:
+        content = s3worker.iter_files_in_sub_dirs(
+            s3_client, the_bucket, the_prefix, app_config['listing_workers'])
+    else:
+        content = s3worker.iter_files_in_dir(s3_client, the_bucket, the_prefix, True)
     # filter out the input files, done file and run log, only keep the output files
-    content = list(filter(lambda x: 'output' in x
-                          and x[-4:] == '.csv'
-                          and run_log_fname_keyword not in x, content))
+    content = filter(lambda x: 'output' in x
+                     and x[-4:] == '.csv'
+                     and run_log_fname_keyword not in x, content)
 
     # group result files by their name, same file name indicates the same output file from each task
     result_file_groups = {}
@@ -62,6 +119,10 @@ def get_result_files(s3_client, the_bucket, the_prefix, run_log_fname_keyword):
         else:
             result_file_groups[filename].append(f)
 
+    # the parallel listing returns keys in no particular order, keep the task order stable
+    for files in result_file_groups.values():
+        files.sort()
+
     return result_file_groups
 
 
@@ -76,9 +137,9 @@ def get_result_files(s3_client, the_bucket, the_prefix, run_log_fname_keyword):
 def consolidate_and_upload(s3, result_file_groups, the_bucket, consolidated_data_prefix):
     for key, val in result_file_groups.items():
         dfs = []
-        for f in result_file_groups[key]:
-            local_copy = s3worker.download_file(s3, the_bucket, f, '/tmp')
-            dfs.append(pd.read_csv(local_copy))
+        for f, data in s3worker.iter_downloads(s3, the_bucket, val, app_config['download_workers'],
+                                               app_config['download_spool_dir']):
+            dfs.append(pd.read_csv(data))
         combined_result = pd.concat(dfs, ignore_index=True)
         combined_file_name = 'combined_' + key
         combined_local_copy = '/tmp/' + combined_file_name
@@ -93,5 +154,298 @@ def consolidate_and_upload(s3, result_file_groups, the_bucket, consolidated_data
         print("directory \"/tmp\" cleared!")
 
 
+
+# same as consolidate_and_upload, streaming the files instead of loading them
+# every file is read in chunks of read_chunk_mb and written to the consolidated file through
+# a multipart upload in parts of upload_part_mb. The header is written once, the header of
+# every file must match the header of the first one.
+# the files downloaded ahead are spooled to download_spool_dir
+# args: same as consolidate_and_upload
+def consolidate_and_upload_streaming(s3, result_file_groups, the_bucket, consolidated_data_prefix):
+    chunk_size = app_config['read_chunk_mb'] * 1024 * 1024
+    part_size = app_config['upload_part_mb'] * 1024 * 1024
+    for key, val in result_file_groups.items():
+        combined_file_name = 'combined_' + key
+        print("streaming " + str(len(val)) + " result files to s3 bucket. file: " +
+              combined_file_name)
+        output = s3worker.StreamingUpload(s3, the_bucket, consolidated_data_prefix + combined_file_name,
+                                          part_size)
+        try:
+            output.write(UTF8_BOM)
+            header = None
+            for f, data in s3worker.iter_downloads(s3, the_bucket, val, app_config['download_workers'],
+                                                   app_config['download_spool_dir']):
+                part_header, rest = read_header(data, chunk_size)
+                if not part_header:
+                    print("skipping empty result file: " + f)
+                    continue
+                if header is None:
+                    header = part_header
+                    output.write(header if header.endswith(b'\n') else header + b'\n')
+                elif part_header.rstrip(b'\r\n') != header.rstrip(b'\r\n'):
+                    raise ValueError("The header of " + f + " does not match the header of " +
+                                     "the other files of " + key)
+
+                last_chunk = rest
+                output.write(rest)
+                for chunk in iter(lambda: data.read(chunk_size), b''):
+                    output.write(chunk)
+                    last_chunk = chunk
+                # the next file starts on a new line
+                if last_chunk and not last_chunk.endswith(b'\n'):
+                    output.write(header[len(header.rstrip(b'\r\n')):] or b'\n')
+        except Exception:
+            output.abort()
+            raise
+        output.complete()
+        print("uploading done")
+
+
+# read the first line of a file
+#   - returns: the line with its line ending and without byte order mark,
+#     and the rest of the bytes read so far
+def read_header(data, chunk_size):
+    content = b''
+    while b'\n' not in content:
+        chunk = data.read(chunk_size)
+        if not chunk:
+            break
+        content += chunk
+    if content.startswith(UTF8_BOM):
+        content = content[len(UTF8_BOM):]
+    end = content.find(b'\n') + 1 or len(content)
+    return content[:end], content[end:]
+
+
+
+# write the result files of every group as one parquet file, combined_<name>.parquet
+# there is a row group per well of a task, see split_by_well.
+# the files are written in two passes: every file goes to a local segment file with the column
+# types of its own, then the segments are converted to the column types of all of them, see
+# unify_column_types, and written into the combined file. Only one file is in memory at a time
+# next to it goes a sidecar index, combined_<name>.parquet.index.json, see build_parquet_index
+# args: same as consolidate_and_upload
+def consolidate_to_parquet(s3, result_file_groups, the_bucket, consolidated_data_prefix):
+    spool_dir = app_config['download_spool_dir'] or tempfile.gettempdir()
+    # the wells of the image sets of every task, by the key of its image file list
+    task_wells = {}
+    for key, val in result_file_groups.items():
+        combined_file_name = 'combined_' + os.path.splitext(key)[0] + '.parquet'
+        local_copy = os.path.join(spool_dir, combined_file_name)
+        segment_dir = tempfile.mkdtemp(dir=spool_dir)
+        print("writing " + str(len(val)) + " result files to parquet file: " + combined_file_name)
+        writer = None
+        # (segment file, column types, columns without values, (task id, well, number of rows) of
+        # every well) of every result file with rows
+        segments = []
+        try:
+            for f, data in s3worker.iter_downloads(s3, the_bucket, val, app_config['download_workers'],
+                                                   app_config['download_spool_dir']):
+                try:
+                    df = pd.read_csv(data)
+                except pd.errors.EmptyDataError:
+                    df = pd.DataFrame()
+                if len(df) == 0:
+                    print("skipping result file without rows: " + f)
+                    continue
+
+                # keys look like <sub_task_record_prefix><task_id>/output/<name>
+                task_dir = f.split('/output/')[0]
+                task_id = task_dir.split('/')[-1]
+                # the dispatcher writes the image file list of a task to
+                # <sub_task_record_prefix><task_id>/input/<task_id>.csv
+                file_list_key = task_dir + '/input/' + task_id + '.csv'
+                def get_image_wells():
+                    if file_list_key not in task_wells:
+                        task_wells[file_list_key] = read_image_wells(s3, the_bucket, file_list_key)
+                    return task_wells[file_list_key]
+
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                segment = os.path.join(segment_dir, str(len(segments)) + '.parquet')
+                wells = [(task_id, well, len(rows)) for well, rows in split_by_well(df, get_image_wells)]
+                pq.write_table(table, segment, compression='none')
+                segments.append((segment, table.schema,
+                                 [column for column in df.columns if df[column].isnull().all()], wells))
+
+            if not segments:
+                print("no rows in " + key + ", no parquet file written")
+                continue
+
+            schema = unify_column_types([x[1:3] for x in segments])
+            writer = pq.ParquetWriter(local_copy, schema, compression=app_config['parquet_compression'])
+            # (task id, well, number of rows) of every write, in order
+            writes = []
+            for segment, segment_schema, empty_columns, wells in segments:
+                df = pq.read_table(segment).to_pandas()
+                os.remove(segment)
+                first_row = 0
+                for task_id, well, num_rows in wells:
+                    writer.write_table(conform_to_schema(df.iloc[first_row:first_row + num_rows],
+                                                         segment_schema, schema))
+                    writes.append((task_id, well, num_rows))
+                    first_row += num_rows
+            writer.close()
+            writer = None
+
+            index = build_parquet_index(local_copy, writes)
+            print("uploading parquet file with " + str(len(index['row_groups'])) + " row groups")
+            s3worker.upload_file(s3, local_copy, the_bucket, consolidated_data_prefix + combined_file_name)
+            s3worker.upload_content(s3, json.dumps(index).encode('utf-8'), the_bucket,
+                                    consolidated_data_prefix + combined_file_name + '.index.json')
+            print("uploading done")
+        finally:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(local_copy):
+                os.remove(local_copy)
+            shutil.rmtree(segment_dir, ignore_errors=True)
+
+
+# the wells of the image sets of a task, from the Well_Location column of its image file list.
+# CellProfiler numbers the image sets of a task by their row in the list
+#   - returns: {image number: well}
+def read_image_wells(s3, the_bucket, file_list_key):
+    response = s3.get_object(Bucket=the_bucket, Key=file_list_key)
+    rows = pd.read_csv(io.BytesIO(response['Body'].read()), usecols=['Well_Location'], dtype=str)
+    return dict((i + 1, well) for i, well in enumerate(rows['Well_Location']))
+
+
+# split the rows of a task file by well, consecutive rows of a well stay together
+# the well of a row is its WELL_COLUMN. Tables without one take the well of their image set,
+# a task may hold several wells. Tables without image numbers are one part without a well
+#   - get_image_wells: returns {image number: well} of the task, see read_image_wells
+#   - returns: a list of (well, rows)
+def split_by_well(df, get_image_wells):
+    if WELL_COLUMN in df.columns:
+        wells = df[WELL_COLUMN].astype(str)
+    elif IMAGE_NUMBER_COLUMN in df.columns:
+        wells = df[IMAGE_NUMBER_COLUMN].map(get_image_wells()).fillna('')
+    else:
+        return [(None, df)]
+    runs = (wells != wells.shift()).cumsum()
+    return [(wells[rows.index[0]], rows) for _, rows in df.groupby(runs, sort=False)]
+
+
+# the column types of the combined file, from the column types of every result file:
+# ints and floats are combined into floats, any other mix of types, or a column without
+# values in every file, is a string column. A column of ints with files that lack it or
+# have no values in it is float, like pandas would make it.
+# the columns are in the order they are first seen
+#   - file_types: (pyarrow schema, names of the columns without values) of every result file
+#   - returns: the pyarrow schema
+def unify_column_types(file_types):
+    names = []
+    # name: {type name: type} of the files with values in the column
+    types = {}
+    for schema, empty_columns in file_types:
+        for field in schema:
+            if field.name not in types:
+                names.append(field.name)
+                types[field.name] = {}
+            if field.name not in empty_columns:
+                types[field.name][str(field.type)] = field.type
+
+    fields = []
+    for name in names:
+        with_values = len([x for x in file_types if name in x[0].names and name not in x[1]])
+        found = set(types[name].keys())
+        if found == set(['int64']) and with_values < len(file_types):
+            column_type = pa.float64()
+        elif found and found <= set(['int64', 'double']):
+            column_type = pa.float64() if 'double' in found else pa.int64()
+        elif len(found) == 1:
+            column_type = list(types[name].values())[0]
+        else:
+            column_type = pa.string()
+        fields.append(pa.field(name, column_type))
+    return pa.schema(fields)
+
+
+# convert rows of a result file to the column types of the combined file
+#   - df: the rows
+#   - file_schema: the column types of the result file
+#   - schema: the column types of the combined file, see unify_column_types
+#   - returns: a pyarrow table
+def conform_to_schema(df, file_schema, schema):
+    arrays = []
+    for field in schema:
+        if field.name not in df.columns or df[field.name].isnull().all():
+            arrays.append(pa.array([None] * len(df), type=field.type))
+            continue
+        values = df[field.name]
+        file_type = file_schema[file_schema.names.index(field.name)].type
+        if field.type == pa.string() and file_type != pa.string():
+            arrays.append(pa.array([None if pd.isnull(x) else str(x) for x in values], type=pa.string()))
+        elif field.type == pa.float64():
+            arrays.append(pa.array(values.astype('float64'), type=field.type, from_pandas=True))
+        else:
+            arrays.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, names=schema.names)
+
+
+# the sidecar index of a parquet file, so readers can fetch parts of it with ranged reads:
+#   - footer: [offset, length] of the parquet footer, which readers need to decode any part.
+#     it is small and can be kept
+#   - columns: name and type of every column
+#   - row_groups: task id, well, number of rows and the [offset, length] of every row group,
+#     and of each of its column chunks. A row group or a column chunk is one ranged read
+#   - wells: [offset, length] and the row groups of every well. The range covers all the row
+#     groups of the well, so a well is one ranged read. Empty for tables without wells
+# args:
+#   - local_copy: the parquet file
+#   - writes: (task id, well, number of rows) of every table written, in order.
+#     a large table may have been written as several row groups
+def build_parquet_index(local_copy, writes):
+    metadata = pq.read_metadata(local_copy)
+    file_size = os.path.getsize(local_copy)
+    # the file ends with the footer length (4 bytes, little endian) and "PAR1"
+    with open(local_copy, 'rb') as f:
+        f.seek(file_size - 8)
+        footer_length = struct.unpack('<i', f.read(4))[0]
+
+    index = {
+        'num_rows': metadata.num_rows,
+        'file_size': file_size,
+        'footer': [file_size - 8 - footer_length, footer_length + 8],
+        'columns': [{'name': field.name, 'type': str(field.type)}
+                    for field in metadata.schema.to_arrow_schema()],
+        'row_groups': [],
+        'wells': {}
+    }
+
+    write_index = -1
+    rows_left = 0
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        if rows_left == 0:
+            write_index += 1
+            rows_left = writes[write_index][2]
+        rows_left -= row_group.num_rows
+        task_id, well = writes[write_index][:2]
+
+        columns = {}
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            offset = column.data_page_offset
+            # the dictionary page, if any, comes before the data pages
+            if column.has_dictionary_page and column.dictionary_page_offset > 0:
+                offset = min(offset, column.dictionary_page_offset)
+            columns[column.path_in_schema] = [offset, column.total_compressed_size]
+        start = min(x[0] for x in columns.values())
+        end = max(x[0] + x[1] for x in columns.values())
+        index['row_groups'].append({'task_id': task_id, 'well': well, 'num_rows': row_group.num_rows,
+                                    'range': [start, end - start], 'columns': columns})
+
+        if well is None:
+            continue
+        if well not in index['wells']:
+            index['wells'][well] = {'range': [start, end - start], 'row_groups': [i]}
+        else:
+            well_entry = index['wells'][well]
+            well_entry['range'][1] = end - well_entry['range'][0]
+            well_entry['row_groups'].append(i)
+    return index
+
+
 if __name__ == '__main__':
     main()